@@ -84,6 +84,16 @@ function_role = t.add_resource(
                     Action=[
                         Action("cloudformation", "GetTemplate")],
                     Resource=["*"]
+                ), Statement(
+                    Effect=Allow,
+                    Action=[
+                        Action("cloudformation", "DescribeStackResource")],
+                    Resource=["*"]
+                ), Statement(
+                    Effect=Allow,
+                    Action=[
+                        Action("cloudformation", "DescribeStacks")],
+                    Resource=["*"]
                 ), Statement(
                     Effect=Allow,
                     Action=[
@@ -99,6 +109,10 @@ function_role = t.add_resource(
                     Action=[
                         Action("lambda", "GetFunction")],
                     Resource=["arn:aws:lambda:*:*:function:*"]
+                ), Statement(
+                    Effect=Allow,
+                    Action=[Action("lambda", "InvokeFunction")],
+                    Resource=["arn:aws:lambda:*:*:function:*"]
                 ), Statement(
                     Effect=Allow,
                     Action=[Action("lambda", "ListTags")],
@@ -141,6 +155,8 @@ rds_macro_lambda = t.add_resource(
             'restore_point_in_time': 'false',
             'properties_to_remove': '',
             'properties_to_add': '',
+            'resolve_from_stack_resources': 'true',
+            'restore_in_background': 'false',
         }
         ),
         Description="Function used to manipulate the dbinstance template",
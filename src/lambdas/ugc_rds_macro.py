@@ -1,29 +1,543 @@
+import copy
+import functools
+import hashlib
 import json
 import logging
 import os
+import random
 import sys
+import threading
+import time
 import traceback
 import uuid
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta, timezone
 from io import StringIO
 
-import boto3
 from botocore.exceptions import ClientError
-from dateutil.parser import parse
 
-logger = logging.getLogger(__name__)
+log_payload_max_chars = 2048
 
 snap_shot_types = set(['automated', 'manual', 'shared', 'public', 'awsbackup'])
 
 
-client = boto3.client('rds')
-cf_client = boto3.client('cloudformation')
-lambda_client = boto3.client('lambda')
+# Module attributes that resolve to the lazily created clients.
+_client_attributes = {
+    'client': 'rds',
+    'cf_client': 'cloudformation',
+    'lambda_client': 'lambda',
+}
 
 do_not_ignore_get_template = True
+template_cache_max_entries = 32
+template_cache_ttl_seconds = 300
+prefetch_max_workers = 4
+ugc_database_logical_id = 'UGCDatabase'
+db_instance_resource_type = 'AWS::RDS::DBInstance'
 point_in_time_db_instance_tag = 'ugc:point-in-time:dbinstance'
 point_in_time_snapshot_db_instance_tag = 'ugc:point-in-time:snapshot:dbinstance'
 create_snapshot_tag = 'ugc:create-snaphost:dbinstance'
+tag_key_max_length = 128
+
+
+class _Payload(object):
+    # Log argument that is only serialised when the record is emitted. The
+    # encoder is consumed lazily so large payloads stop being encoded once
+    # log_payload_max_chars have been produced.
+    __slots__ = ('value',)
+    _encoder = json.JSONEncoder(default=str)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        chunks = []
+        size = 0
+        for chunk in self._encoder.iterencode(self.value):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > log_payload_max_chars:
+                return "{0}...<truncated>".format(
+                    "".join(chunks)[:log_payload_max_chars])
+
+        return "".join(chunks)
+
+
+def _payload(value):
+    return _Payload(value)
+
+
+class InvocationLogger(logging.LoggerAdapter):
+    # Adds the context of the current invocation to every record. Formatting
+    # of the message and its arguments is left to logging, which only does it
+    # for records that are emitted.
+
+    def __init__(self, logger):
+        super(InvocationLogger, self).__init__(logger, {})
+        self._prefix = ""
+        logger.addFilter(self._add_context)
+
+    def bind(self, **context):
+        self.extra = context
+        self._prefix = "[{0}] ".format(" ".join(
+            "{0}={1}".format(k, v) for k, v in sorted(context.items())))
+
+    def clear(self):
+        self.extra = {}
+        self._prefix = ""
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        return msg, kwargs
+
+    def _add_context(self, record):
+        # funcName is found by logging for every emitted record, reuse it
+        # rather than inspecting the stack in each function.
+        record.msg = "{0}:{1}:{2}".format(
+            self._prefix, record.funcName, record.msg)
+        return True
+
+
+logger = InvocationLogger(logging.getLogger(__name__))
+
+
+# Attempts of one AWS call, including the first. botocore's adaptive retry
+# mode backs off exponentially with jitter and, once the service starts
+# throttling, rate limits the client as well.
+api_max_attempts = 6
+api_retry_mode = 'adaptive'
+
+# Calls per second and burst allowed to each type of call of a service,
+# shared by every invocation in the container. A throttled call halves the
+# rate of its type, each call that goes through wins back a tenth of it.
+api_call_budgets = {
+    'read': (20, 40),
+    'tags': (5, 10),
+    'write': (5, 10),
+}
+api_min_rate = 0.5
+api_rate_increase = 0.1
+
+throttling_error_codes = set([
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'ProvisionedThroughputExceededException',
+    'SlowDown', 'PriorRequestNotComplete'])
+
+
+def api_call_type(operation_name):
+    if operation_name in ('ListTags', 'TagResource', 'UntagResource'):
+        return 'tags'
+    if operation_name.startswith(('Describe', 'List', 'Get')):
+        return 'read'
+    return 'write'
+
+
+class TokenBucket(object):
+    # Paces callers to rate per second after a burst. A caller takes its
+    # token straight away and sleeps off any debt outside the lock, so
+    # threads queue up in the order they asked.
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(api_min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * api_rate_increase)
+
+
+class ApiCallLimiter(object):
+    # Hooks into the events of every client: paces each call on the budget
+    # of its type, adapts that budget to throttling, and counts calls,
+    # throttled attempts and retries for the invocation log.
+
+    def __init__(self, budgets=None, clock=time.monotonic, sleep=time.sleep):
+        self.budgets = api_call_budgets if budgets is None else budgets
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def register(self, service_client):
+        events = service_client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('needs-retry', self._needs_retry)
+        events.register('after-call', self._after_call)
+
+    def _key(self, operation_model):
+        return "{0}.{1}".format(operation_model.service_model.service_name,
+                                api_call_type(operation_model.name))
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    rate, burst = self.budgets[key.split('.')[-1]]
+                    bucket = self._buckets[key] = TokenBucket(
+                        rate, burst, self._clock, self._sleep)
+        return bucket
+
+    def _count(self, key, name, value=1):
+        with self._lock:
+            counts = self._counts.setdefault(
+                key, {'calls': 0, 'throttles': 0, 'retries': 0, 'paced_s': 0.0})
+            counts[name] += value
+
+    def _before_call(self, model, **kwargs):
+        key = self._key(model)
+        waited = self._bucket(key).acquire()
+        if waited:
+            self._count(key, 'paced_s', waited)
+
+    def _needs_retry(self, operation, response=None, **kwargs):
+        # Sees every attempt that went to the service, before botocore
+        # decides whether to retry it.
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in throttling_error_codes:
+            key = self._key(operation)
+            self._count(key, 'throttles')
+            self._bucket(key).throttled()
+        return None
+
+    def _after_call(self, model, parsed=None, **kwargs):
+        key = self._key(model)
+        parsed = parsed or {}
+        self._count(key, 'calls')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            self._count(key, 'retries', retries)
+        if not 'Error' in parsed:
+            self._bucket(key).succeeded()
+
+    def reset_counts(self):
+        with self._lock:
+            self._counts = {}
+
+    def counts(self):
+        with self._lock:
+            return dict((key, dict(value)) for key, value in self._counts.items())
+
+
+api_limiter = ApiCallLimiter()
+
+# Connections are kept open between warm invocations, so only a cold start
+# pays for the TLS handshakes. The pool has room for every prefetch thread
+# and the asyncio executor; the timeouts keep a slow endpoint from eating
+# into the lambda's time, each attempt being retried as above.
+client_min_pool_connections = 16
+client_connect_timeout_seconds = 2
+client_read_timeout_seconds = 20
+
+
+def client_config():
+    from botocore.exceptions import InvalidRetryConfigurationError
+    options = {
+        # The region of the lambda itself, so every call goes to its
+        # regional endpoint.
+        'region_name': os.environ.get('AWS_REGION') or None,
+        'max_pool_connections': max(client_min_pool_connections, prefetch_max_workers + 1),
+        'connect_timeout': client_connect_timeout_seconds,
+        'read_timeout': client_read_timeout_seconds,
+        'retries': {'mode': api_retry_mode, 'total_max_attempts': api_max_attempts},
+    }
+    try:
+        return _botocore_config(options)
+    except InvalidRetryConfigurationError:
+        # botocore before 1.15 has no retry modes, only the number of retries
+        # after the first attempt.
+        options['retries'] = {'max_attempts': api_max_attempts - 1}
+        return _botocore_config(options)
+
+
+def _botocore_config(options):
+    from botocore.config import Config
+    try:
+        return Config(tcp_keepalive=True, **options)
+    except TypeError:
+        # botocore before 1.27.84 has no tcp_keepalive.
+        return Config(**options)
+
+
+def create_client(session, service_name, limiter=None):
+    # Every client of the lambda is built here.
+    service_client = session.client(service_name, config=client_config())
+    (limiter or api_limiter).register(service_client)
+    return service_client
+
+
+def log_api_calls():
+    counts = api_limiter.counts()
+    throttles = sum(value['throttles'] for value in counts.values())
+    if throttles:
+        logger.warning("aws calls were throttled %s times: %s", throttles, counts)
+    else:
+        logger.info("aws calls: %s", counts)
+
+
+class ClientProvider(object):
+    # Creates each boto3 client the first time it is used, all from one
+    # session, so an invocation that only needs CloudFormation never pays for
+    # importing boto3 or building the rds and lambda clients.
+
+    def __init__(self, limiter=None):
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._limiter = limiter
+
+    def session(self):
+        if self._session is None:
+            import boto3
+            self._session = boto3.session.Session()
+        return self._session
+
+    def get(self, service_name):
+        service_client = self._clients.get(service_name)
+        if service_client is None:
+            with self._lock:
+                service_client = self._clients.get(service_name)
+                if service_client is None:
+                    service_client = create_client(
+                        self.session(), service_name, self._limiter)
+                    self._clients[service_name] = service_client
+        return service_client
+
+    def created(self):
+        return sorted(self._clients)
+
+
+clients = ClientProvider()
+
+
+def _rds():
+    return clients.get('rds')
+
+
+def _cloudformation():
+    return clients.get('cloudformation')
+
+
+def _lambda():
+    return clients.get('lambda')
+
+
+def _dynamodb():
+    return clients.get('dynamodb')
+
+
+def __getattr__(name):
+    if name in _client_attributes:
+        return clients.get(_client_attributes[name])
+    raise AttributeError(
+        "module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+class MacroConfigError(ValueError):
+    pass
+
+
+restore_state_stores = set(['lambda_tags', 'dynamodb', 'sqlite'])
+default_restore_state_path = '/tmp/ugc_rds_macro_restore_state.db'
+default_restore_poll_interval_seconds = 30
+default_restore_wait_margin_seconds = 60
+restore_wait_initial_seconds = 5
+max_idempotency_window_seconds = 3600
+
+
+def _parse_flag(name, value):
+    value = value.strip().lower()
+    if value in ('', 'false'):
+        return False
+    if value == 'true':
+        return True
+    raise MacroConfigError(
+        "{0} must be true or false, not {1!r}".format(name, value))
+
+
+def _parse_seconds(name, value, default):
+    value = value.strip()
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1
+    if seconds < 0:
+        raise MacroConfigError(
+            "{0} must be a number of seconds, not {1!r}".format(name, value))
+    return seconds
+
+
+def _parse_properties_to_add(value):
+    # Either a json array of objects, or json objects separated by commas.
+    # Decoding object by object keeps commas inside values intact.
+    value = value.strip()
+    if not value:
+        return ()
+    decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+    try:
+        if value.startswith('['):
+            objects = decoder.decode(value)
+        else:
+            objects = []
+            i = 0
+            while i < len(value):
+                obj, i = decoder.raw_decode(value, i)
+                objects.append(obj)
+                while i < len(value) and value[i] in ', \t\r\n':
+                    i += 1
+    except ValueError as e:
+        raise MacroConfigError(
+            "properties_to_add is not valid json: {0}".format(e))
+
+    properties = []
+    for obj in objects:
+        if not isinstance(obj, dict):
+            raise MacroConfigError(
+                "properties_to_add entries must be json objects, not {0!r}".format(obj))
+        properties.extend(obj.items())
+    return tuple(properties)
+
+
+def _parse_properties_to_remove(value):
+    value = value.strip()
+    if value.startswith('['):
+        try:
+            names = json.loads(value)
+        except ValueError as e:
+            raise MacroConfigError(
+                "properties_to_remove is not valid json: {0}".format(e))
+    else:
+        names = value.split(",")
+    return tuple(str(name).strip() for name in names if str(name).strip())
+
+
+class MacroConfig(namedtuple('MacroConfig', [
+        'log_level', 'rds_snapshot_stack_name', 'replace_with_snapshot',
+        'snapshot_id', 'snapshot_type', 'properties_to_add',
+        'properties_to_remove', 'restore_point_in_time', 'restore_time',
+        'resolve_from_stack_resources', 'restore_state_store',
+        'restore_state_table', 'restore_state_path', 'restore_in_background',
+        'restore_poll_interval_seconds', 'restore_wait_in_invocation',
+        'restore_wait_margin_seconds', 'idempotency_window_seconds'])):
+    # Lambda configuration, parsed and validated from the environment once.
+    __slots__ = ()
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        environ = os.environ if environ is None else environ
+
+        def value(name):
+            return environ.get(name, '')
+
+        log_level = logging.getLevelName(
+            (value('log_level').strip() or 'INFO').upper())
+        if not isinstance(log_level, int):
+            raise MacroConfigError(
+                "log_level is not valid: {0!r}".format(value('log_level')))
+
+        snapshot_type = value('snapshot_type').strip().lower()
+        if snapshot_type and not snapshot_type in snap_shot_types:
+            raise MacroConfigError(
+                "SUPPLIED SNAP SHOT TYPE NOT VALID: {0!r}".format(snapshot_type))
+
+        restore_state_store = value('restore_state_store').strip().lower() or 'lambda_tags'
+        if not restore_state_store in restore_state_stores:
+            raise MacroConfigError(
+                "restore_state_store is not valid: {0!r}".format(restore_state_store))
+        restore_state_table = value('restore_state_table').strip()
+        if restore_state_store == 'dynamodb' and not restore_state_table:
+            raise MacroConfigError(
+                "restore_state_table is needed when restore_state_store is dynamodb")
+
+        restore_in_background = _parse_flag(
+            'restore_in_background', value('restore_in_background'))
+        if restore_in_background and restore_state_store == 'lambda_tags':
+            # Tags can not tell the background invocation and a stack update
+            # apart when both move the same restore on.
+            raise MacroConfigError(
+                "restore_in_background needs restore_state_store dynamodb or sqlite")
+
+        idempotency_window_seconds = _parse_seconds(
+            'idempotency_window_seconds', value('idempotency_window_seconds'), 0)
+        if idempotency_window_seconds > max_idempotency_window_seconds:
+            raise MacroConfigError(
+                "idempotency_window_seconds must be at most {0}, not {1!r}".format(
+                    max_idempotency_window_seconds, idempotency_window_seconds))
+
+        return cls(
+            log_level=log_level,
+            rds_snapshot_stack_name=value('rds_snapshot_stack_name').strip().lower(),
+            replace_with_snapshot=_parse_flag(
+                'replace_with_snapshot', value('replace_with_snapshot')),
+            snapshot_id=value('snapshot_id').strip(),
+            snapshot_type=snapshot_type,
+            properties_to_add=_parse_properties_to_add(value('properties_to_add')),
+            properties_to_remove=_parse_properties_to_remove(
+                value('properties_to_remove')),
+            restore_point_in_time=_parse_flag(
+                'restore_point_in_time', value('restore_point_in_time')),
+            restore_time=value('restore_time').strip(),
+            resolve_from_stack_resources=_parse_flag(
+                'resolve_from_stack_resources', value('resolve_from_stack_resources')),
+            restore_state_store=restore_state_store,
+            restore_state_table=restore_state_table,
+            restore_state_path=value('restore_state_path').strip() or default_restore_state_path,
+            restore_in_background=restore_in_background,
+            restore_poll_interval_seconds=_parse_seconds(
+                'restore_poll_interval_seconds', value('restore_poll_interval_seconds'),
+                default_restore_poll_interval_seconds),
+            restore_wait_in_invocation=_parse_flag(
+                'restore_wait_in_invocation', value('restore_wait_in_invocation')),
+            restore_wait_margin_seconds=_parse_seconds(
+                'restore_wait_margin_seconds', value('restore_wait_margin_seconds'),
+                default_restore_wait_margin_seconds),
+            idempotency_window_seconds=idempotency_window_seconds)
+
+
+_config_variables = MacroConfig._fields
+_config_cache = {}
+
+
+def get_config():
+    # The environment of a Lambda container never changes, so this parses
+    # once per container. Keying on the raw values keeps it correct when it
+    # does change, as in tests.
+    key = tuple(os.environ.get(name) for name in _config_variables)
+    config = _config_cache.get(key)
+    if config is None:
+        config = MacroConfig.from_environ()
+        _config_cache.clear()
+        _config_cache[key] = config
+    return config
 
 
 def _format_stacktrace():
@@ -33,68 +547,505 @@ def _format_stacktrace():
     return "".join(parts)
 
 
-def _add_snapshot_identifier(fragment, snapshot_id):
-    for key, value in fragment.items():
-        if key == 'Properties':
-            db_snapshot_id = {'DBSnapshotIdentifier': snapshot_id}
-            value.update(db_snapshot_id)
+class RdsInventory(object):
+    # Paginated listing of the db instances in the account, fetched at most
+    # once and shared by every phase of a single handler invocation. Loading
+    # is locked, so a phase reading it waits for a prefetch in progress.
+
+    def __init__(self, instances=None, rds_client=None):
+        self._rds_client = rds_client
+        self._instances = None
+        self._resolver = None
+        self._known = {}
+        self._load_lock = threading.Lock()
+        if instances is not None:
+            self._index(instances)
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(instances=response['DBInstances'])
+
+    def _index(self, instances):
+        instances = list(instances)
+        self._by_identifier = {}
+        self._by_status = {}
+        for instance in instances:
+            self._by_identifier[str(instance['DBInstanceIdentifier'])] = instance
+            status = str(instance.get('DBInstanceStatus', '')).lower()
+            self._by_status.setdefault(status, []).append(instance)
+        # Set last, a loaded inventory is always fully indexed.
+        self._instances = instances
+
+    def load(self):
+        if self._instances is None:
+            with self._load_lock:
+                if self._instances is None:
+                    rds = self._rds_client or _rds()
+                    paginator = rds.get_paginator('describe_db_instances')
+                    instances = []
+                    for page in paginator.paginate():
+                        instances.extend(page['DBInstances'])
+                    logger.debug("fetched %s db instances", len(instances))
+                    self._index(instances)
+        return self
+
+    @property
+    def loaded(self):
+        return self._instances is not None
+
+    @property
+    def instances(self):
+        return self.load()._instances
+
+    def __len__(self):
+        return len(self.instances)
+
+    def add(self, instance):
+        # Remember an instance described on its own, without listing the account.
+        self._known[str(instance['DBInstanceIdentifier'])] = instance
+
+    def by_identifier(self, instance_id):
+        instance = self._known.get(str(instance_id))
+        if instance is None:
+            instance = self.load()._by_identifier.get(str(instance_id))
+        return instance
+
+    def by_status(self, status):
+        return list(self.load()._by_status.get(str(status).lower(), []))
+
+    def resolver(self):
+        if self._resolver is None:
+            self._resolver = StackInstanceResolver(self.instances)
+        return self._resolver
+
+
+class StackInstanceResolver(object):
+    # Sorted index of subnet group names used to find the db instance that
+    # belongs to a stack. CloudFormation names the subnet group
+    # "<stack name>-<logical id>-<suffix>", so every candidate for a stack
+    # sits in one contiguous run of the sorted names.
+
+    def __init__(self, instances):
+        entries = []
+        for instance in instances:
+            subnet_group = instance.get('DBSubnetGroup')
+            if subnet_group and 'DBSubnetGroupName' in subnet_group:
+                entries.append((str(subnet_group['DBSubnetGroupName']),
+                                str(instance['DBInstanceIdentifier'])))
+        entries.sort()
+        self._names = [name for name, _ in entries]
+        self._instance_ids = [instance_id for _, instance_id in entries]
+
+    def __len__(self):
+        return len(self._names)
+
+    def candidates(self, stack_name):
+        stack_name = str(stack_name)
+        i = bisect_left(self._names, stack_name)
+        while i < len(self._names) and self._names[i].startswith(stack_name):
+            yield self._names[i], self._instance_ids[i]
+            i += 1
+
+    def resolve(self, stack_name):
+        # Prefer subnet groups where the stack name ends on a "-" boundary,
+        # so "dv-rds" never beats "dv-rds-..." for the stack "dv-rds", then
+        # the shortest remaining suffix, then name order.
+        stack_name = str(stack_name)
+        best = None
+        best_rank = None
+        for name, instance_id in self.candidates(stack_name):
+            remainder = name[len(stack_name):]
+            rank = (not remainder.startswith('-'), len(remainder), name)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = instance_id, rank
+
+        return best
+
+
+class TTLCache(object):
+    # Bounded LRU cache whose entries also expire after ttl_seconds. Lives at
+    # module level so warm containers keep it between invocations.
+
+    def __init__(self, max_entries, ttl_seconds, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if self._clock() < expires:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        return None
 
+    def put(self, key, value):
+        self._entries[key] = (self._clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        if predicate is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if predicate(k)]:
+            del self._entries[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+deployed_template_cache = TTLCache(
+    template_cache_max_entries, template_cache_ttl_seconds)
+
+
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def _get_prefetch_executor():
+    # One small pool per container, kept across invocations.
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        with _prefetch_executor_lock:
+            if _prefetch_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _prefetch_executor = ThreadPoolExecutor(
+                    max_workers=prefetch_max_workers)
+    return _prefetch_executor
+
+
+class HandlerPrefetch(object):
+    # Starts the AWS calls of an invocation that do not depend on each other
+    # side by side, so the phases wait for the slowest of them rather than
+    # for all of them in turn. A phase asks for a result by name and makes
+    # the call itself when it was not prefetched.
+
+    def __init__(self, stack_of_interest, inventory, config=None, context=None,
+                 logical_ids=(ugc_database_logical_id,)):
+        self._futures = {}
+        self._restore_state_stores = {}
+        if prefetch_max_workers < 1:
+            return
+
+        self._start('deployed_resources', get_deployed_resources, stack_of_interest)
+        if config is None:
+            return
+
+        restoring = config.restore_point_in_time and not config.replace_with_snapshot
+        if (config.replace_with_snapshot and not config.snapshot_id
+                and not config.resolve_from_stack_resources):
+            # Read through the inventory lock, no result to hand over.
+            self._start('inventory', inventory.load)
+        for logical_id in logical_ids:
+            if config.replace_with_snapshot and not config.snapshot_id:
+                self._start(('latest_snapshot_arn', logical_id), find_latest_snapshot_arn,
+                            config.rds_snapshot_stack_name or stack_of_interest,
+                            inventory, config, logical_id)
+            if restoring:
+                try:
+                    store = get_restore_state_store(
+                        get_invoked_function_arn(context), config,
+                        restore_scope(stack_of_interest, logical_id))
+                except Exception as e:
+                    # Left to the restore, which keeps the deployed template
+                    # when it can not reach its store either.
+                    logger.warning("unable to prefetch restore state of %s: %s", logical_id, e)
+                    continue
+                self._restore_state_stores[logical_id] = store
+                self._start(('restore_state', logical_id), _prefetch_restore_state,
+                            store, inventory, config, logical_id)
+
+    def restore_state_store(self, logical_id=ugc_database_logical_id):
+        return self._restore_state_stores.get(logical_id)
+
+    def _start(self, name, fn, *args):
+        self._futures[name] = _get_prefetch_executor().submit(fn, *args)
+
+    def result(self, name, fn, *args):
+        # Each prefetched result is handed out once, later reads call again.
+        future = self._futures.pop(name, None)
+        if future is None:
+            return fn(*args)
+        return future.result()
+
+
+def _prefetch_restore_state(store, inventory, config, logical_id):
+    # Only a restore about to start looks for its source instance, and only
+    # needs the inventory when that is found by subnet group.
+    restore_state = store.get()
+    if (restore_state.phase == restore_phase_idle and logical_id == ugc_database_logical_id
+            and not config.resolve_from_stack_resources):
+        inventory.load()
+    return restore_state
+
+
+def _prefetched(prefetch, name, fn, *args):
+    if prefetch is None:
+        return fn(*args)
+    return prefetch.result(name, fn, *args)
+
+
+def _as_inventory(instances):
+    if isinstance(instances, RdsInventory):
+        return instances
+    if instances is None:
+        return RdsInventory()
+    return RdsInventory.from_response(instances)
+
+
+# Edits of a fragment's Properties. The configured edits are compiled once
+# per config into an ordered list, then applied in one pass; a path with
+# dots, such as MonitoringConfig.Interval, reaches into nested properties.
+FragmentOp = namedtuple('FragmentOp', ['stage', 'action', 'path', 'value'])
+
+op_remove = 'remove'
+op_set = 'set'
+# Sets the snapshot identifier given when the ops are applied, if any.
+op_snapshot = 'snapshot'
+
+stage_snapshot = 'snapshot'
+stage_remove = 'remove'
+stage_add = 'add'
+
+snapshot_fragment_ops = (
+    FragmentOp(stage_snapshot, op_remove, ('DBInstanceIdentifier',), None),
+    FragmentOp(stage_snapshot, op_remove, ('DBName',), None),
+    FragmentOp(stage_snapshot, op_snapshot, ('DBSnapshotIdentifier',), None))
+
+
+def _property_path(name):
+    return tuple(part.strip() for part in name.strip().split('.'))
+
+
+def compile_fragment_ops(config):
+    ops = []
+    if config.replace_with_snapshot:
+        ops.extend(snapshot_fragment_ops)
+    for prop in config.properties_to_remove:
+        ops.append(FragmentOp(stage_remove, op_remove, _property_path(prop), None))
+    for prop, prop_value in config.properties_to_add:
+        ops.append(FragmentOp(stage_add, op_set, _property_path(prop), prop_value))
+    return tuple(ops)
+
+
+_fragment_ops_cache = {}
+
+
+def get_fragment_ops(config, stage=None):
+    # Configs are parsed once per environment, so this compiles once too.
+    entry = _fragment_ops_cache.get(id(config))
+    if entry is None or entry[0] is not config:
+        entry = (config, compile_fragment_ops(config), {})
+        _fragment_ops_cache.clear()
+        _fragment_ops_cache[id(config)] = entry
+    if stage is None:
+        return entry[1]
+    ops = entry[2].get(stage)
+    if ops is None:
+        ops = entry[2][stage] = tuple(op for op in entry[1] if op.stage == stage)
+    return ops
+
+
+def _fragment_properties(fragment):
+    if isinstance(fragment, dict):
+        properties = fragment.get('Properties')
+        if isinstance(properties, dict):
+            return properties
+    return None
 
-def check_if_snapshot_identifier_needs_be_added(fragment, deployed_template):
-    func_name = traceback.extract_stack(None, 2)[0][2]
 
+def _child(node, part, create=False):
+    if isinstance(node, list):
+        if part.isdigit() and int(part) < len(node):
+            return node[int(part)]
+        return None
+    child = node.get(part)
+    if child is None and create:
+        child = node[part] = OrderedDict()
+    return child
+
+
+def _apply_fragment_op(properties, op, value):
+    node = properties
+    for part in op.path[:-1]:
+        node = _child(node, part, op.action != op_remove)
+        if not isinstance(node, (dict, list)):
+            return False
+    leaf = op.path[-1]
+    if isinstance(node, list):
+        if not (leaf.isdigit() and int(leaf) < len(node)):
+            return False
+        leaf = int(leaf)
+    elif op.action == op_remove and leaf not in node:
+        return False
+
+    if op.action == op_remove:
+        del node[leaf]
+    else:
+        node[leaf] = value
+    return True
+
+
+def apply_fragment_ops(fragment, ops, snapshot_id=None):
+    properties = _fragment_properties(fragment)
+    if properties is None:
+        return fragment
+    for op in ops:
+        if op.action == op_snapshot:
+            if snapshot_id is None:
+                continue
+            value = snapshot_id
+        elif op.action == op_set:
+            # Each fragment gets its own copy of the configured value.
+            value = copy.deepcopy(op.value)
+        else:
+            value = None
+        if not _apply_fragment_op(properties, op, value):
+            logger.debug("unable to %s property = [%s] of fragment",
+                         op.action, '.'.join(op.path))
+    return fragment
+
+
+def check_if_snapshot_identifier_needs_be_added(fragment, deployed_template):
     fragment_snapshot_id = get_snapshot_identifier(fragment)
     snapshot_id = get_snapshot_identifier(deployed_template)
-    logger.debug(":{0}:snapshot id of [fragment = {1} deployed = {2} ".format(
-        func_name,  fragment_snapshot_id, snapshot_id))
+    logger.debug("snapshot id of [fragment = %s deployed = %s ",
+                 fragment_snapshot_id, snapshot_id)
     if snapshot_id != None and fragment_snapshot_id == None:
-        logger.debug(":{0}:add snapshot id to template {1}".format(
-            func_name, snapshot_id))
-        _remove_property(fragment, "DBInstanceIdentifier")
-        _remove_property(fragment, "DBName")
-        _add_snapshot_identifier(fragment, snapshot_id)
+        logger.debug("add snapshot id to template %s", snapshot_id)
+        apply_fragment_ops(fragment, snapshot_fragment_ops, snapshot_id)
 
     return get_snapshot_identifier(fragment)
 
 
-def get_ugc_database_template(stack_of_interest):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    if do_not_ignore_get_template:
-        try:
-            response = cf_client.get_template(
-                StackName=stack_of_interest, TemplateStage='Processed')
-
-            logger.debug(":{0}:deployed_template:{1}".format(
-                func_name, str(json.dumps(response,  default=str))))
-            db_inst_temp = json.dumps(
-                response['TemplateBody']['Resources']['UGCDatabase'],  default=str)
-            logger.debug(":{0}:deployed_db_instance_template:{1}".format(
-                func_name, str(db_inst_temp)))
-            return db_inst_temp
-        except (ClientError, KeyError) as e:
-            stack_trace = _format_stacktrace()
-            logger.error(":{0}:problems getting deployed template: {1}".format(
-                func_name, stack_trace))
+def _stack_update_marker(response):
+    for stack in response['Stacks']:
+        return str(stack.get('LastUpdatedTime') or stack['CreationTime'])
 
     return None
 
 
-def get_snapshot_identifier(dbinstance_template):
-    func_name = traceback.extract_stack(None, 2)[0][2]
+def _template_resources(get_template_response):
+    template_body = get_template_response['TemplateBody']
+    if isinstance(template_body, str):
+        template_body = json.loads(template_body)
+    return template_body['Resources']
+
 
+def _deployed_resource(resources, logical_id=ugc_database_logical_id):
+    if resources is None:
+        return None
+    db_inst_temp = resources.get(logical_id)
+    if db_inst_temp is None:
+        logger.error("problems getting deployed template: no %s resource", logical_id)
+    logger.debug("deployed_db_instance_template:%s", _payload(db_inst_temp))
+    return db_inst_temp
+
+
+def invalidate_deployed_template(stack_of_interest=None):
+    if stack_of_interest is None:
+        deployed_template_cache.invalidate()
+    else:
+        deployed_template_cache.invalidate(
+            lambda key: key[0] == stack_of_interest)
+
+
+def _deployed_resources_calls(stack_of_interest):
+    # The marker and cache logic of the deployed template, shared by the
+    # sync and the asyncio pipeline, which each make the two cloudformation
+    # calls their own way. Yields (operation, params) for every call and is
+    # sent its response, or thrown its error.
+    if not do_not_ignore_get_template:
+        return None
+
+    marker = None
+    try:
+        marker = _stack_update_marker((yield (
+            'describe_stacks', {'StackName': stack_of_interest})))
+    except (ClientError, KeyError):
+        logger.debug("no update marker for stack %s", stack_of_interest)
+    if marker:
+        resources = deployed_template_cache.get((stack_of_interest, marker))
+        logger.debug("deployed template cache %s", deployed_template_cache.stats())
+        if resources is not None:
+            return resources
+
+    try:
+        resources = _template_resources((yield (
+            'get_template', {'StackName': stack_of_interest, 'TemplateStage': 'Processed'})))
+        if marker:
+            deployed_template_cache.put((stack_of_interest, marker), resources)
+        return resources
+    except (ClientError, KeyError, ValueError) as e:
+        stack_trace = _format_stacktrace()
+        logger.error("problems getting deployed template: %s", stack_trace)
+
+    return None
+
+
+def _run_calls(calls, call):
+    # Makes each (operation, params) call asked for by a generator such as
+    # _deployed_resources_calls, and returns what the generator returns.
+    try:
+        request = next(calls)
+        while True:
+            try:
+                response = call(*request)
+            except Exception as e:
+                request = calls.throw(e)
+            else:
+                request = calls.send(response)
+    except StopIteration as e:
+        return e.value
+
+
+def get_deployed_resources(stack_of_interest):
+    # Every resource of the deployed stack, fetched once per stack update.
+    return _run_calls(_deployed_resources_calls(stack_of_interest),
+                      lambda operation, params: getattr(_cloudformation(), operation)(**params))
+
+
+def get_ugc_database_template(stack_of_interest, logical_id=ugc_database_logical_id):
+    return _deployed_resource(get_deployed_resources(stack_of_interest), logical_id)
+
+
+def iter_db_instance_resources(template):
+    for logical_id, resource in template.get('Resources', {}).items():
+        if isinstance(resource, dict) and resource.get('Type') == db_instance_resource_type:
+            yield logical_id, resource
+
+
+def restore_scope(stackname, logical_id=ugc_database_logical_id):
+    # The restore state of a stack's UGCDatabase keeps the plain stack scope.
+    if logical_id == ugc_database_logical_id:
+        return stackname
+    return "{0}:{1}".format(stackname, logical_id)
+
+
+def get_snapshot_identifier(dbinstance_template):
     if dbinstance_template:
         db = dbinstance_template
         if type(dbinstance_template) is str:
             db = json.loads(dbinstance_template)
 
-        v = json.dumps(db)
-        logger.debug(":{0}:{1}".format(func_name, str(v)))
         try:
             snapshot_id = db["Properties"]["DBSnapshotIdentifier"]
         except KeyError:
-            stack_trace = _format_stacktrace()
-            logger.debug(":{0}:no snapshot identifier: {1}: {2}".format(
-                func_name, dbinstance_template, stack_trace))
+            logger.debug("no snapshot identifier: %s",
+                         _payload(dbinstance_template))
             return None
 
         return snapshot_id
@@ -102,269 +1053,762 @@ def get_snapshot_identifier(dbinstance_template):
     return None
 
 
-def update_snapshot(fragment, stack_of_interest):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    # Fetching latest snapshot
-    rds_snapshot_stack_name = os.environ['rds_snapshot_stack_name'].rstrip( ).lower()
-    replace_with_snapshot = os.environ.get(
-        'replace_with_snapshot').rstrip().lower()
-    if replace_with_snapshot == "true":
-        snapshot_id = os.environ.get("snapshot_id").rstrip()
-
-        _remove_property(fragment, "DBInstanceIdentifier")
-        _remove_property(fragment, "DBName")
-
-        if snapshot_id:
-            _add_snapshot_identifier(fragment, snapshot_id)
-            logger.debug(":{0}:adding snapshot = {1}".format(
-                func_name, snapshot_id))
-        elif rds_snapshot_stack_name:
-            _create_snapshot_using_stack_name(
-                rds_snapshot_stack_name, fragment)
-        else:
-            _create_snapshot_using_stack_name(stack_of_interest, fragment)
-
-def _create_snapshot_using_stack_name(stackname, fragment):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    snapshot_type = os.environ['snapshot_type'].rstrip()
-    instances = client.describe_db_instances()
-    db_instance = parse_db_identifier(instances, stackname)
-    logger.debug(":{0}:creating snapshot for db_instance = [{1}]".format(
-        func_name, db_instance))
+def resolve_snapshot_id(stack_of_interest, inventory=None, config=None, prefetch=None,
+                        logical_id=ugc_database_logical_id):
+    # The snapshot replace_with_snapshot restores from, None when there is none.
+    config = config or get_config()
+    if not config.replace_with_snapshot:
+        return None
+    if config.snapshot_id:
+        logger.debug("adding snapshot = %s", config.snapshot_id)
+        return config.snapshot_id
+    return _latest_snapshot_using_stack_name(
+        config.rds_snapshot_stack_name or stack_of_interest, inventory, config,
+        prefetch, logical_id)
+
+
+def _latest_snapshot_using_stack_name(stackname, inventory=None, config=None, prefetch=None,
+                                      logical_id=ugc_database_logical_id):
+    snap_shot_id = _prefetched(prefetch, ('latest_snapshot_arn', logical_id),
+                               find_latest_snapshot_arn, stackname, inventory, config,
+                               logical_id)
+    if snap_shot_id:
+        logger.info("adding snapshot %s", snap_shot_id)
+    return snap_shot_id
+
+
+def find_latest_snapshot_arn(stackname, inventory=None, config=None,
+                             logical_id=ugc_database_logical_id):
+    config = config or get_config()
+    db_instance = find_stack_db_instance(stackname, inventory, config, logical_id)
+    logger.debug("creating snapshot for db_instance = [%s]", db_instance)
     if db_instance:
-        if snapshot_type:
+        latest = select_latest_snapshot(
+            iter_db_snapshots(db_instance, config.snapshot_type))
+        if latest:
+            return latest['DBSnapshotArn']
 
-            if not snapshot_type in snap_shot_types:
-                raise Exception("SUPPLIED SNAP SHOT TYPE NOT VALID")
+    return None
 
-            snapshots = client.describe_db_snapshots(
-                DBInstanceIdentifier=db_instance, SnapshotType=snapshot_type)
-        else:
-            snapshots = client.describe_db_snapshots(
-                DBInstanceIdentifier=db_instance)
 
-        logger.debug(':{0}:available snapshots: {1}'.format(
-            func_name, snapshots))
+def iter_db_snapshots(db_instance, snapshot_type=None):
+    # Streams the snapshots of an instance, holding one page at a time.
+    params = {'DBInstanceIdentifier': db_instance}
+    if snapshot_type:
+        params['SnapshotType'] = snapshot_type
+
+    paginator = _rds().get_paginator('describe_db_snapshots')
+    for page in paginator.paginate(**params):
+        logger.debug('page of %s snapshots', len(page['DBSnapshots']))
+        for snapshot in page['DBSnapshots']:
+            yield snapshot
+
 
-        all_snap_shots = snapshots['DBSnapshots']
-        if len(all_snap_shots) > 0:
-            snap_shot_id = all_snap_shots[0]['DBSnapshotArn']
-            logger.info(":{0}:adding snapshot {1}".format(
-                func_name, snap_shot_id))
-            _add_snapshot_identifier(fragment, snap_shot_id)
+def select_latest_snapshot(snapshots):
+    # The snapshot type is filtered by describe_db_snapshots, only snapshots
+    # that can be restored from are considered here.
+    latest = None
+    for snapshot in snapshots:
+        if str(snapshot.get('Status', '')).lower() != 'available':
+            continue
+        created = snapshot.get('SnapshotCreateTime')
+        if created is None:
+            continue
+        if latest is None or created > latest['SnapshotCreateTime']:
+            latest = snapshot
 
+    return latest
 
-def add_properties(fragment):
-    # Adding properties
-    properties_to_add = os.environ['properties_to_add']
-    props_to_add = properties_to_add.split(",")
-    if properties_to_add.rstrip():
-        for prop_to_add in props_to_add:
-            for key, value in fragment.items():
-                if key == 'Properties':
-                    p = json.loads(prop_to_add.rstrip())
-                    value.update(p)
 
+def get_instance_state(instance_id, instances):
+    instance = _as_inventory(instances).by_identifier(instance_id)
+    if instance:
+        return instance['DBInstanceStatus']
 
-def remove_properties(fragment):
-    # Remving properties
-    properties_to_remove = os.environ['properties_to_remove']
+    return None
 
-    props_to_remove = properties_to_remove.split(",")
-    if properties_to_remove.rstrip():
-        for prop_to_remove in props_to_remove:
-            _remove_property(fragment, prop_to_remove)
 
+restore_phase_idle = 'idle'
+restore_phase_restoring = 'restoring'
+restore_phase_snapshotting = 'snapshotting'
+restore_phase_ready = 'ready'
+restore_poll_event_key = 'ugc_rds_macro_restore_poll'
+# Status of a restore step claimed before its instance or snapshot exists.
+restore_status_starting = 'starting'
+restore_failed_instance_states = frozenset([
+    'failed', 'incompatible-restore', 'incompatible-network',
+    'incompatible-parameters', 'inaccessible-encryption-credentials'])
+restore_failed_snapshot_states = frozenset(['failed'])
+# Background invocations handed a restore before leaving it to stack updates.
+restore_max_handovers = 16
+
+
+def _restore_tag_key(tag, stackname):
+    if not stackname:
+        return tag
+    key = "{0}:{1}".format(tag, stackname)
+    if len(key) > tag_key_max_length:
+        # Long stack names still get a key of their own.
+        key = "{0}:{1}".format(
+            tag, hashlib.sha1(stackname.encode('utf-8')).hexdigest())
+    return key
+
+
+def restore_state_tag_keys(stackname=None):
+    # The instance and snapshot tag keys holding the restore of one stack.
+    return (_restore_tag_key(point_in_time_db_instance_tag, stackname),
+            _restore_tag_key(point_in_time_snapshot_db_instance_tag, stackname))
+
+
+class RestoreState(namedtuple('RestoreState', [
+        'phase', 'instance_id', 'snapshot_id', 'status', 'tag_keys'])):
+    # Progress of a point in time restore, decoded from the lambda tags.
+    #   ugc:point-in-time:dbinstance:<stack>          = <instance id>:<status>
+    #   ugc:point-in-time:snapshot:dbinstance:<stack> = <snapshot id>:<status>:<instance id>
+    # Without a stack name the keys are the original global ones. A snapshot
+    # with the status ready is available and its instance already deleted.
+    __slots__ = ()
+
+    @classmethod
+    def idle(cls):
+        return cls(restore_phase_idle, None, None, None, ())
+
+    @classmethod
+    def from_tags(cls, tags, stackname=None):
+        instance_key, snapshot_key = restore_state_tag_keys(stackname)
+        keys = tuple(k for k in (instance_key, snapshot_key) if k in tags)
+        if snapshot_key in tags:
+            parts = tags[snapshot_key].split(":")
+            status = _tag_part(parts, 1)
+            phase = restore_phase_snapshotting
+            if status == restore_phase_ready:
+                phase = restore_phase_ready
+            return cls(phase, _tag_part(parts, 2), _tag_part(parts, 0),
+                       status, keys)
+        if instance_key in tags:
+            parts = tags[instance_key].split(":")
+            return cls(restore_phase_restoring,
+                       _tag_part(parts, 0), None, _tag_part(parts, 1), keys)
+        return cls.idle()._replace(tag_keys=keys)
+
+    def to_tags(self, stackname=None):
+        instance_key, snapshot_key = restore_state_tag_keys(stackname)
+        if self.phase == restore_phase_restoring:
+            return {instance_key: "{0}:{1}".format(
+                self.instance_id, self.status)}
+        if self.phase == restore_phase_snapshotting:
+            return {snapshot_key: "{0}:{1}:{2}".format(
+                self.snapshot_id, self.status, self.instance_id)}
+        if self.phase == restore_phase_ready:
+            return {snapshot_key: "{0}:{1}:{2}".format(
+                self.snapshot_id, restore_phase_ready, self.instance_id)}
+        return {}
+
+
+def _tag_part(parts, index):
+    if index < len(parts) and parts[index]:
+        return parts[index]
+    return None
 
-def _remove_property(fragment, prop):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    try:
-        for key, value in fragment.items():
-            if key == 'Properties':
-                del value[prop.strip()]
-    except KeyError:
-        stack_trace = _format_stacktrace()
-        logger.debug(":{0}:unable to remove property = [{1}] from fragment = [{2}] stack_trace= [{3}]".format(
-            func_name, prop, fragment, stack_trace))
 
+def read_restore_state(lambda_arn, stackname=None):
+    tags = _lambda().list_tags(Resource=lambda_arn)
+    logger.debug("list_of_tags = %s", _payload(tags))
+    return RestoreState.from_tags(tags.get('Tags', {}), stackname)
 
-def get_instance_state(instance_id, instances):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    for val in instances['DBInstances']:
-        if str(val['DBInstanceIdentifier']) in instance_id:
-            return val['DBInstanceStatus']
 
-    return None
+def write_restore_state(lambda_arn, current, new, stackname=None):
+    # One tag_resource and/or one untag_resource call per transition.
+    new_tags = new.to_tags(stackname)
+    if new_tags:
+        res = _lambda().tag_resource(Resource=lambda_arn, Tags=new_tags)
+        logger.info("response from add tag %s", _payload(res))
+    remove_keys = [k for k in current.tag_keys if k not in new_tags]
+    if remove_keys:
+        res = _lambda().untag_resource(Resource=lambda_arn, TagKeys=remove_keys)
+        logger.info("response = [%s]", _payload(res))
+    return new._replace(tag_keys=tuple(new_tags))
 
 
-def remove_tag(tag_to_remove, lambda_arn):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    response = lambda_client.untag_resource(
-        Resource=lambda_arn,
-        TagKeys=[tag_to_remove])
-    logger.info(":{0}: response = [{1}]".format(func_name, str(response)))
-
-
-def add_tag(key, value, lambda_arn):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    tags = {key: value}
-    logger.debug(":{0}: lambda_arn = [{1}]".format(func_name, lambda_arn))
-    res = lambda_client.tag_resource(
-        Resource=lambda_arn, Tags=tags)
-    logger.info(":{0}:response from add tag {1}".format(func_name, res))
-
-def get_tagged_db_instance_from_restore_id(lambda_arn):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    tags = lambda_client.list_tags(Resource=lambda_arn)
-    logger.debug(":{0}: list_of_tags = {1}".format(func_name, str(tags)))
-    snap_shot_id = None
-    point_in_time_instance_id = None
-    for k, v in tags['Tags'].items():
-        if k in point_in_time_snapshot_db_instance_tag:
-            return v.split(":")[2]
-
-def get_tagged_db_instance(lambda_arn):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    tags = lambda_client.list_tags(Resource=lambda_arn)
-    logger.debug(":{0}: list_of_tags = {1}".format(func_name, str(tags)))
-    snap_shot_id = None
-    point_in_time_instance_id = None
-    for k, v in tags['Tags'].items():
-        if k in point_in_time_db_instance_tag:
-            point_in_time_instance_id = v.split(":")[0]
-
-        if k in point_in_time_snapshot_db_instance_tag:
-            snap_shot_id = v.split(":")[0]
-    
-    return (point_in_time_instance_id, snap_shot_id)
+class RestoreStateConflict(Exception):
+    pass
 
-def _create_snapshot_point_in_time(fragment, restored_snapshot_id):
-    _remove_property(fragment, "DBInstanceIdentifier")
-    _remove_property(fragment, "DBName")
-    _add_snapshot_identifier(fragment, restored_snapshot_id)
 
+class RestoreStateStore(ABC):
+    # Where the progress of a point in time restore is kept between
+    # invocations. compare_and_set stores new only if the stored state is
+    # still expected, returning the stored state, and otherwise raises
+    # RestoreStateConflict without changing anything.
 
-def point_in_time_restore(fragment, stack_of_interest, deployed_template):
-    # Restoring to point in time
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    replace_with_snapshot = os.environ.get(
-        'replace_with_snapshot').rstrip().lower()
-    restore = os.environ['restore_point_in_time'].rstrip()
-    restore_time = os.environ['restore_time'].rstrip()
-    resp = None
+    @abstractmethod
+    def get(self):
+        pass
 
-    if restore and replace_with_snapshot != "true":
-        lambda_arn = get_function_arn(os.environ['AWS_LAMBDA_FUNCTION_NAME'])
-        instances = client.describe_db_instances()
-        
-        target_db_instance, restored_snap_shot_id = get_tagged_db_instance(lambda_arn)
-        state = None
-        if target_db_instance:
-            state = get_instance_state(target_db_instance, instances)
-
-        snapshot_state = None
-        if restored_snap_shot_id:
-            snapshot_state = get_snapshot_state(restored_snap_shot_id)
-
-        logger.info("snapshot_id = [{}] state = [{}] target_db_instance_id = [{}] state = [{}]  ")
-        if state == None and snapshot_state == None:
-            db_instance = parse_db_identifier(instances, stack_of_interest)
-            target_db_instance = "tdi"+str(uuid.uuid4())
-            logger.info(":{0}:pefrorming point in time restore curent_db_instance = [{1}] taget_db_instance = [{2}] state = [{3}] restore_time=[{4}]".format(
-                func_name, db_instance, target_db_instance, state, restore_time))
-            try:
-                if restore.lower() == "true" and restore_time:
-                    backup_retention_period = get_back_retention_period(
-                        instances, db_instance)
-                    if not check_if_point_in_time_date_is_valid(restore_time, backup_retention_period):
-                        raise Exception(
-                            "Supplied date {0} is not valid".format(restore_time))
-
-                    resp = client.restore_db_instance_to_point_in_time(
-                        SourceDBInstanceIdentifier=db_instance,
-                        TargetDBInstanceIdentifier=target_db_instance,
-                        RestoreTime=restore_time)
-                elif restore.lower() == "true":
-                    resp = client.restore_db_instance_to_point_in_time(
-                        SourceDBInstanceIdentifier=db_instance,
-                        TargetDBInstanceIdentifier=target_db_instance,
-                        UseLatestRestorableTime=True)
-
-                logger.info(
-                    ":{0}:response from point in time restore = {1}".format(func_name, resp))
-
-                if resp:
-                    add_tag(point_in_time_db_instance_tag,
-                            "{0}:{1}".format(target_db_instance, resp['DBInstance']['DBInstanceStatus']), lambda_arn)
-
-            except ClientError as e:
-                stack_trace = _format_stacktrace()
-                logger.error(":{0}:POINT_IN_TIME_RESTORE:problems creating point in time restore: stack_trace={1}".format(
-                    func_name, stack_trace))
-
-        elif target_db_instance and state.lower() in "available":
-            restored_snapshot_id = "rsi"+str(uuid.uuid4())
-            logger.debug(":{0}:POINT_IN_TIME_RESTORE_CREATING_SNAPSHOT: snapshotid = [{1}]".format(
-                func_name, restored_snapshot_id))
-            res = client.create_db_snapshot(
-                DBSnapshotIdentifier=restored_snapshot_id,
-                DBInstanceIdentifier=target_db_instance)
-            logger.info(":{0}:response from create_snapshot_of_point_in_time={1}".format(
-                func_name, str(res)))
-            
-            ss = res['DBSnapshot']['Status']
-            if ss.lower() == 'available':
-                _create_snapshot_point_in_time(fragment, restored_snapshot_id)
+    @abstractmethod
+    def compare_and_set(self, expected, new):
+        pass
 
-            else:
-                add_tag(point_in_time_snapshot_db_instance_tag, "{0}:{1}:{2}".format(restored_snapshot_id, ss.lower(), target_db_instance), lambda_arn)
-
-            remove_tag(point_in_time_db_instance_tag, lambda_arn)
-            #delete_db_instance(target_db_instance)
-            
-
-        elif restored_snap_shot_id and snapshot_state.lower() in "available":
-             _create_snapshot_point_in_time(fragment, restored_snap_shot_id)
-             db = get_tagged_db_instance_from_restore_id(lambda_arn)
-             delete_db_instance(db)
-             remove_tag(point_in_time_snapshot_db_instance_tag, lambda_arn)
-             
+    # Stores that can hold more than a tag also keep small records for other
+    # uses, as (expires_at, value) by key. Others keep nothing.
+
+    def get_record(self, key):
+        return None
+
+    def put_record(self, key, expires_at, value):
+        pass
+
+
+def _same_restore_state(a, b):
+    # tag_keys records where a state was read from, not the state itself.
+    return a[:4] == b[:4]
+
+
+def _encode_restore_state(state):
+    return json.dumps({'phase': state.phase, 'instance_id': state.instance_id,
+                       'snapshot_id': state.snapshot_id, 'status': state.status},
+                      sort_keys=True)
+
+
+def _decode_restore_state(value):
+    if value is None:
+        return RestoreState.idle()
+    state = json.loads(value)
+    return RestoreState(state['phase'], state['instance_id'],
+                        state['snapshot_id'], state['status'], ())
+
+
+class LambdaTagStateStore(RestoreStateStore):
+    # The state in the tags of the lambda itself, as it has always been kept.
+    # Tags have no conditional write, so compare_and_set only checks expected
+    # against the state this store last read; two invocations racing on the
+    # same restore are not detected.
+
+    def __init__(self, lambda_arn, stackname=None):
+        self.lambda_arn = lambda_arn
+        self.stackname = stackname
+        self._last = None
+
+    def get(self):
+        self._last = read_restore_state(self.lambda_arn, self.stackname)
+        return self._last
+
+    def compare_and_set(self, expected, new):
+        current = self._last if self._last is not None else self.get()
+        if not _same_restore_state(current, expected):
+            raise RestoreStateConflict(
+                "restore state is {0}, not {1}".format(current, expected))
+        self._last = write_restore_state(
+            self.lambda_arn, current, new, self.stackname)
+        return self._last
+
+
+class DynamoDbStateStore(RestoreStateStore):
+    # One item per key, written with a conditional put or delete.
+
+    def __init__(self, table_name, key, dynamodb_client=None):
+        self.table_name = table_name
+        self.key = key
+        self._dynamodb_client = dynamodb_client
+
+    def _client(self):
+        return self._dynamodb_client or _dynamodb()
+
+    def get(self):
+        res = self._client().get_item(
+            TableName=self.table_name, Key={'id': {'S': self.key}},
+            ConsistentRead=True)
+        item = res.get('Item')
+        return _decode_restore_state(item['state']['S'] if item else None)
+
+    def compare_and_set(self, expected, new):
+        if expected.phase == restore_phase_idle:
+            condition = {'ConditionExpression': 'attribute_not_exists(id)'}
         else:
-            if state != None:
-                logger.info(":{0}: state of point in time restore {1}", func_name, str(state))
+            condition = {'ConditionExpression': '#state = :expected',
+                         'ExpressionAttributeNames': {'#state': 'state'},
+                         'ExpressionAttributeValues': {
+                             ':expected': {'S': _encode_restore_state(expected)}}}
+        try:
+            if new.phase == restore_phase_idle:
+                if expected.phase == restore_phase_idle:
+                    stored = self.get()
+                    if stored.phase != restore_phase_idle:
+                        raise RestoreStateConflict(
+                            "restore state of {0} is no longer {1}".format(self.key, expected))
+                    return stored
+                self._client().delete_item(
+                    TableName=self.table_name, Key={'id': {'S': self.key}},
+                    **condition)
+            else:
+                self._client().put_item(
+                    TableName=self.table_name,
+                    Item={'id': {'S': self.key},
+                          'state': {'S': _encode_restore_state(new)}},
+                    **condition)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                raise RestoreStateConflict(
+                    "restore state of {0} is no longer {1}".format(self.key, expected))
+            raise
+        return new._replace(tag_keys=())
+
+    def get_record(self, key):
+        res = self._client().get_item(
+            TableName=self.table_name, Key={'id': {'S': key}}, ConsistentRead=True)
+        item = res.get('Item')
+        if not item or 'record' not in item:
+            return None
+        return (float(item['expires']['N']), item['record']['S'])
+
+    def put_record(self, key, expires_at, value):
+        # expires can be the table's TTL attribute, removing stale records.
+        self._client().put_item(
+            TableName=self.table_name,
+            Item={'id': {'S': key}, 'expires': {'N': str(int(expires_at))},
+                  'record': {'S': value}})
+
+
+class SqliteStateStore(RestoreStateStore):
+    # A local database file, for tests and benchmarks.
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS restore_state "
+                       "(id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS record "
+                       "(id TEXT PRIMARY KEY, expires REAL NOT NULL, value TEXT NOT NULL)")
+
+    def _connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self):
+        db = self._connect()
+        try:
+            row = db.execute("SELECT state FROM restore_state WHERE id = ?",
+                             (self.key,)).fetchone()
+        finally:
+            db.close()
+        return _decode_restore_state(row[0] if row else None)
+
+    def compare_and_set(self, expected, new):
+        idle = restore_phase_idle
+        db = self._connect()
+        try:
+            with db:
+                if expected.phase == idle and new.phase == idle:
+                    changed = not db.execute(
+                        "SELECT 1 FROM restore_state WHERE id = ?",
+                        (self.key,)).fetchone()
+                elif expected.phase == idle:
+                    changed = db.execute(
+                        "INSERT OR IGNORE INTO restore_state (id, state) VALUES (?, ?)",
+                        (self.key, _encode_restore_state(new))).rowcount == 1
+                elif new.phase == idle:
+                    changed = db.execute(
+                        "DELETE FROM restore_state WHERE id = ? AND state = ?",
+                        (self.key, _encode_restore_state(expected))).rowcount == 1
+                else:
+                    changed = db.execute(
+                        "UPDATE restore_state SET state = ? WHERE id = ? AND state = ?",
+                        (_encode_restore_state(new), self.key,
+                         _encode_restore_state(expected))).rowcount == 1
+        finally:
+            db.close()
+        if not changed:
+            raise RestoreStateConflict(
+                "restore state of {0} is no longer {1}".format(self.key, expected))
+        return new._replace(tag_keys=())
+
+    def get_record(self, key):
+        db = self._connect()
+        try:
+            row = db.execute("SELECT expires, value FROM record WHERE id = ?",
+                             (key,)).fetchone()
+        finally:
+            db.close()
+        return tuple(row) if row else None
+
+    def put_record(self, key, expires_at, value):
+        db = self._connect()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO record (id, expires, value) VALUES (?, ?, ?)",
+                           (key, expires_at, value))
+        finally:
+            db.close()
+
+
+def get_restore_state_store(lambda_arn, config=None, stackname=None):
+    # Every stack has a restore of its own, so the state is keyed by stack.
+    config = config or get_config()
+    key = lambda_arn if not stackname else "{0}/{1}".format(lambda_arn, stackname)
+    if config.restore_state_store == 'dynamodb':
+        return DynamoDbStateStore(config.restore_state_table, key)
+    if config.restore_state_store == 'sqlite':
+        return SqliteStateStore(config.restore_state_path, key)
+    return LambdaTagStateStore(lambda_arn, stackname)
+
+
+def _create_snapshot_point_in_time(fragment, restored_snapshot_id):
+    apply_fragment_ops(fragment, snapshot_fragment_ops, restored_snapshot_id)
+
+
+def _claim_restore_snapshot(store, restore_state):
+    # Moves the restore on to snapshotting before the snapshot is created, so
+    # only the invocation that wins the transition creates one.
+    target_db_instance = restore_state.instance_id
+    restored_snapshot_id = "rsi"+str(uuid.uuid4())
+    logger.debug("POINT_IN_TIME_RESTORE_CREATING_SNAPSHOT: snapshotid = [%s]",
+                 restored_snapshot_id)
+    claimed = store.compare_and_set(restore_state, RestoreState(
+        restore_phase_snapshotting, target_db_instance,
+        restored_snapshot_id, restore_status_starting, ()))
+    try:
+        res = _rds().create_db_snapshot(
+            DBSnapshotIdentifier=restored_snapshot_id,
+            DBInstanceIdentifier=target_db_instance)
+    except ClientError:
+        store.compare_and_set(claimed, restore_state)
+        raise
+    logger.info("response from create_snapshot_of_point_in_time=%s",
+                _payload(res))
+    return store.compare_and_set(claimed, claimed._replace(
+        status=res['DBSnapshot']['Status'].lower()))
+
+
+def _advance_point_in_time_restore(fragment, stack_of_interest, store, instances, config, context=None, restore_state=None,
+                                   logical_id=ugc_database_logical_id):
+    restore_time = config.restore_time
+    resp = None
+
+    if restore_state is None:
+        restore_state = store.get()
+    if restore_state.phase == restore_phase_ready:
+        return _apply_ready_restore(fragment, store, restore_state)
+
+    target_db_instance = None
+    restored_snap_shot_id = restore_state.snapshot_id
+    if restore_state.phase == restore_phase_restoring:
+        target_db_instance = restore_state.instance_id
+
+    state = None
+    if target_db_instance:
+        state = get_db_instance_state(target_db_instance)
+
+    snapshot_state = None
+    if restored_snap_shot_id:
+        snapshot_state = get_snapshot_state(restored_snap_shot_id)
+
+    logger.info("snapshot_id = [%s] state = [%s] target_db_instance_id = [%s] state = [%s]",
+                restored_snap_shot_id, snapshot_state, target_db_instance, state)
+    if _restore_has_failed(restore_state, state, snapshot_state):
+        restore_state = _abandon_restore(store, restore_state, state)
+
+    elif restore_state.phase == restore_phase_idle:
+        db_instance = find_stack_db_instance(
+            stack_of_interest, instances, config, logical_id)
+        target_db_instance = "tdi"+str(uuid.uuid4())
+        logger.info("pefrorming point in time restore curent_db_instance = [%s] taget_db_instance = [%s] state = [%s] restore_time=[%s]",
+                    db_instance, target_db_instance, state, restore_time)
+        if restore_time:
+            backup_retention_period = get_back_retention_period(
+                instances, db_instance)
+            if not check_if_point_in_time_date_is_valid(restore_time, backup_retention_period):
+                raise Exception(
+                    "Supplied date {0} is not valid".format(restore_time))
+
+        # Claimed before the instance exists, so that of two invocations
+        # starting the restore at once only one creates an instance.
+        idle = restore_state
+        restore_state = store.compare_and_set(idle, RestoreState(
+            restore_phase_restoring, target_db_instance, None,
+            restore_status_starting, ()))
+        try:
+            if restore_time:
+                resp = _rds().restore_db_instance_to_point_in_time(
+                    SourceDBInstanceIdentifier=db_instance,
+                    TargetDBInstanceIdentifier=target_db_instance,
+                    RestoreTime=restore_time)
             else:
-                logger.info(":{0}: state of point in time snaphost {1}", func_name, snapshot_id)
+                resp = _rds().restore_db_instance_to_point_in_time(
+                    SourceDBInstanceIdentifier=db_instance,
+                    TargetDBInstanceIdentifier=target_db_instance,
+                    UseLatestRestorableTime=True)
+
+            logger.info("response from point in time restore = %s",
+                        _payload(resp))
+            restore_state = store.compare_and_set(restore_state, restore_state._replace(
+                status=resp['DBInstance']['DBInstanceStatus']))
+
+            if config.restore_in_background:
+                start_background_restore(stack_of_interest, context, logical_id)
+
+        except ClientError as e:
+            stack_trace = _format_stacktrace()
+            logger.error("POINT_IN_TIME_RESTORE:problems creating point in time restore: stack_trace=%s",
+                         stack_trace)
+            restore_state = store.compare_and_set(restore_state, idle)
+
+    elif target_db_instance and state and state.lower() == "available":
+        restore_state = _claim_restore_snapshot(store, restore_state)
+        if restore_state.status == 'available':
+            restored_snapshot_id = restore_state.snapshot_id
+            restore_state = store.compare_and_set(restore_state, RestoreState.idle())
+            _create_snapshot_point_in_time(fragment, restored_snapshot_id)
+            _delete_restored_db_instance(target_db_instance)
+
+    elif restored_snap_shot_id and snapshot_state and snapshot_state.lower() == "available":
+        # Only the invocation that ends the restore deletes the instance.
+        instance_id = restore_state.instance_id
+        restore_state = store.compare_and_set(restore_state, RestoreState.idle())
+        _create_snapshot_point_in_time(fragment, restored_snap_shot_id)
+        if instance_id:
+            _delete_restored_db_instance(instance_id)
+
+    else:
+        if restore_state.phase == restore_phase_restoring:
+            logger.info("state of point in time restore %s", state)
+        else:
+            logger.info("state of point in time snaphost %s", snapshot_state)
+
+    return restore_state
+
+
+def _restore_has_failed(restore_state, state, snapshot_state):
+    # A restore whose instance or snapshot failed or has gone will never be
+    # ready. One only just claimed may not have reached rds yet.
+    if restore_state.phase == restore_phase_restoring:
+        current, failed = state, restore_failed_instance_states
+    elif restore_state.phase == restore_phase_snapshotting:
+        current, failed = snapshot_state, restore_failed_snapshot_states
+    else:
+        return False
+    if current is None:
+        return restore_state.status != restore_status_starting
+    return current.lower() in failed
+
+
+def _abandon_restore(store, restore_state, state):
+    # Ends the restore, deleting its instance unless it failed to appear.
+    logger.error("POINT_IN_TIME_RESTORE:giving up on restore, %s of instance %s snapshot %s is %s",
+                 restore_state.phase, restore_state.instance_id,
+                 restore_state.snapshot_id, restore_state.status)
+    idle = store.compare_and_set(restore_state, RestoreState.idle())
+    if restore_state.instance_id and (
+            state is not None or restore_state.phase == restore_phase_snapshotting):
+        _delete_restored_db_instance(restore_state.instance_id)
+    return idle
+
+
+def _delete_restored_db_instance(instance_id):
+    # The restore state has already moved on, so a failed delete leaves the
+    # instance behind rather than losing the snapshot it was restored into.
+    try:
+        delete_db_instance(instance_id)
+    except ClientError as e:
+        logger.error("POINT_IN_TIME_RESTORE:problems deleting restored instance %s: stack_trace=%s",
+                     instance_id, _format_stacktrace())
+
+
+def _apply_ready_restore(fragment, store, restore_state):
+    # Snapshotted and cleaned up already, only left to apply.
+    idle = store.compare_and_set(restore_state, RestoreState.idle())
+    _create_snapshot_point_in_time(fragment, restore_state.snapshot_id)
+    return idle
+
+
+def point_in_time_restore(fragment, stack_of_interest, deployed_template, inventory=None, config=None, context=None, prefetch=None,
+                          logical_id=ugc_database_logical_id):
+    # Restoring to point in time
+    config = config or get_config()
+
+    if config.restore_point_in_time and not config.replace_with_snapshot:
+        store = prefetch.restore_state_store(logical_id) if prefetch is not None else None
+        if store is None:
+            store = get_restore_state_store(
+                get_invoked_function_arn(context), config,
+                restore_scope(stack_of_interest, logical_id))
+        try:
+            restore_state = _advance_point_in_time_restore(
+                fragment, stack_of_interest, store, _as_inventory(inventory), config,
+                context, _prefetched(prefetch, ('restore_state', logical_id), store.get),
+                logical_id)
+            if config.restore_wait_in_invocation:
+                restore_state = wait_for_restore(store, restore_state, config, context)
+                if restore_state.phase == restore_phase_ready:
+                    _apply_ready_restore(fragment, store, restore_state)
+        except RestoreStateConflict as e:
+            # Another invocation moved the restore on first, it owns the transition.
+            logger.warning("point in time restore state changed underneath us: %s", e)
 
     return fragment
 
 
+def _restore_poll_event(stackname, logical_id=ugc_database_logical_id, handovers=0):
+    poll = {'stackname': stackname}
+    if logical_id != ugc_database_logical_id:
+        poll['logical_id'] = logical_id
+    if handovers:
+        poll['handovers'] = handovers
+    return json.dumps({restore_poll_event_key: poll}).encode('utf-8')
+
+
+def start_background_restore(stackname, context=None, logical_id=ugc_database_logical_id,
+                             handovers=0):
+    # Hands the restore of the stack to an asynchronous invocation of this
+    # lambda, which moves it on without waiting for another stack update.
+    res = _lambda().invoke(
+        FunctionName=get_invoked_function_arn(context), InvocationType='Event',
+        Payload=_restore_poll_event(stackname, logical_id, handovers))
+    logger.info("started background restore of %s: %s", stackname,
+                res.get('StatusCode'))
+
+
+def advance_restore(store):
+    # One step of a restore that does not need the template: snapshot the
+    # restored instance, then delete it once the snapshot is available.
+    restore_state = store.get()
+    if restore_state.phase == restore_phase_restoring:
+        state = get_db_instance_state(restore_state.instance_id)
+        logger.info("state of point in time restore %s", state)
+        if _restore_has_failed(restore_state, state, None):
+            return _abandon_restore(store, restore_state, state)
+        if state and state.lower() == 'available':
+            return _claim_restore_snapshot(store, restore_state)
+
+    elif restore_state.phase == restore_phase_snapshotting:
+        snapshot_state = get_snapshot_state(restore_state.snapshot_id)
+        logger.info("state of point in time snaphost %s", snapshot_state)
+        if _restore_has_failed(restore_state, None, snapshot_state):
+            return _abandon_restore(store, restore_state, None)
+        if snapshot_state and snapshot_state.lower() == 'available':
+            ready = store.compare_and_set(restore_state, restore_state._replace(
+                phase=restore_phase_ready, status=restore_phase_ready))
+            if restore_state.instance_id:
+                _delete_restored_db_instance(restore_state.instance_id)
+            return ready
+
+    return restore_state
+
+
+def get_deadline(context=None, margin_seconds=0, clock=time.monotonic):
+    # When this invocation has to stop waiting, leaving margin_seconds to
+    # return. Without a lambda context there is no time to wait at all.
+    remaining = get_remaining_time_millis(context)
+    if remaining is None:
+        return clock()
+    return clock() + remaining / 1000.0 - margin_seconds
+
+
+def backoff_delays(initial_seconds, max_seconds, rnd=random):
+    # Exponential backoff with jitter: each delay is between half and all of
+    # a doubling step, capped at max_seconds.
+    step = min(initial_seconds, max_seconds)
+    while True:
+        yield step / 2.0 + rnd.uniform(0, step / 2.0)
+        step = min(max_seconds, step * 2)
+
+
+def wait_for_restore(store, restore_state, config, context=None, clock=time.monotonic):
+    # Keeps advancing the restore until it is ready to apply, or until the
+    # next wait would run past the deadline of this invocation.
+    deadline = get_deadline(context, config.restore_wait_margin_seconds, clock)
+    delays = backoff_delays(restore_wait_initial_seconds,
+                            config.restore_poll_interval_seconds)
+    while restore_state.phase in (restore_phase_restoring, restore_phase_snapshotting):
+        delay = next(delays)
+        if clock() + delay > deadline:
+            logger.info("stopped waiting on point in time restore, %s is %s",
+                        restore_state.phase, restore_state.status)
+            break
+        time.sleep(delay)
+        restore_state = advance_restore(store)
+    return restore_state
+
+
+def poll_restore(stackname, config=None, context=None, logical_id=ugc_database_logical_id,
+                 handovers=0):
+    # Advances the restore until it is ready to apply, handing over to a new
+    # invocation when this one is about to run out of time. After
+    # restore_max_handovers the restore is left for stack updates to move on.
+    config = config or get_config()
+    store = get_restore_state_store(get_invoked_function_arn(context), config,
+                                    restore_scope(stackname, logical_id))
+    try:
+        restore_state = wait_for_restore(store, advance_restore(store), config, context)
+    except RestoreStateConflict as e:
+        logger.warning("point in time restore state changed underneath us: %s", e)
+        return store.get()
+
+    if restore_state.phase not in (restore_phase_idle, restore_phase_ready):
+        if handovers < restore_max_handovers:
+            start_background_restore(stackname, context, logical_id, handovers + 1)
+        else:
+            logger.error("POINT_IN_TIME_RESTORE:stopped polling restore of %s after %d hand-overs, %s is %s",
+                         stackname, handovers, restore_state.phase, restore_state.status)
+    return restore_state
+
+
+def poll_restore_handler(event, context):
+    stackname = event[restore_poll_event_key]['stackname']
+    logical_id = event[restore_poll_event_key].get('logical_id', ugc_database_logical_id)
+    handovers = event[restore_poll_event_key].get('handovers', 0)
+    logger.bind(stackname=stackname)
+    api_limiter.reset_counts()
+    config = get_config()
+    logger.setLevel(config.log_level)
+    restore_state = poll_restore(stackname, config, context, logical_id, handovers)
+    log_api_calls()
+    return {'stackname': stackname, 'phase': restore_state.phase}
+
+
 def parse_db_identifier(response, key):
-    found = None
-    for item in response['DBInstances']:
-        for k, v in item.items():
-            if str(k) in str('DBInstanceIdentifier'):
-                db_inst_id = str(v)
+    return _as_inventory(response).resolver().resolve(key)
 
-            if str(k) == str('DBSubnetGroup'):
-                if str(v['DBSubnetGroupName']).startswith(key):
-                    db_instance_id = db_inst_id
-                    db_subnet_group = v['DBSubnetGroupName']
-                    found = True
 
-    if found:
-        return db_instance_id
+def describe_stack_db_instance(stackname, logical_id=ugc_database_logical_id):
+    try:
+        resource = _cloudformation().describe_stack_resource(
+            StackName=stackname, LogicalResourceId=logical_id)
+        physical_id = resource['StackResourceDetail']['PhysicalResourceId']
+        response = _rds().describe_db_instances(DBInstanceIdentifier=physical_id)
+        for instance in response['DBInstances']:
+            return instance
+    except (ClientError, KeyError):
+        logger.info("unable to find %s in stack %s, falling back to the subnet group",
+                    logical_id, stackname)
+
+    return None
+
 
-    return found
+def find_stack_db_instance(stackname, inventory=None, config=None,
+                           logical_id=ugc_database_logical_id):
+    config = config or get_config()
+    inventory = _as_inventory(inventory)
+    if config.resolve_from_stack_resources or logical_id != ugc_database_logical_id:
+        instance = describe_stack_db_instance(stackname, logical_id)
+        if instance:
+            inventory.add(instance)
+            return str(instance['DBInstanceIdentifier'])
+
+    if logical_id != ugc_database_logical_id:
+        # Subnet group names only tell the UGCDatabase of each stack apart.
+        return None
+    return parse_db_identifier(inventory, stackname)
 
 
 def check_if_point_in_time_date_is_valid(pnt_in_time, backup_retention_period):
-    func_name = traceback.extract_stack(None, 2)[0][2]
+    # Only restores with a restore_time need dateutil, import it on demand.
+    from dateutil.parser import parse
     try:
         datetime = parse(pnt_in_time)
     except ValueError as e:
         stack_trace = _format_stacktrace()
-        logger.error("{0}:POINT_IN_TIME_DATE_IS_NOT_VALID: point_in_time = {1}: stack_trace={2}".format(
-            func_name, pnt_in_time, stack_trace))
+        logger.error("POINT_IN_TIME_DATE_IS_NOT_VALID: point_in_time = %s: stack_trace=%s",
+                     pnt_in_time, stack_trace)
         return False
 
     today = datetime.now(timezone.utc)
@@ -374,84 +1818,421 @@ def check_if_point_in_time_date_is_valid(pnt_in_time, backup_retention_period):
 
 
 def get_back_retention_period(instances, instance_id):
-    for v in instances['DBInstances']:
-        if str(v['DBInstanceIdentifier']) in instance_id:
-            return int(v['BackupRetentionPeriod'])
+    instance = _as_inventory(instances).by_identifier(instance_id)
+    if instance:
+        return int(instance['BackupRetentionPeriod'])
 
 
 def delete_db_instance(db_instance_id):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    response = client.delete_db_instance(
+    response = _rds().delete_db_instance(
         DBInstanceIdentifier=db_instance_id, SkipFinalSnapshot=True)
-    logger.info(":{0}: reponse from deleting instance:{1}".format(
-        func_name, response))
+    logger.info("reponse from deleting instance:%s", _payload(response))
     return response['DBInstance']['DBInstanceIdentifier']
 
 
 def get_function_arn(f_name):
-    func_name = traceback.extract_stack(None, 2)[0][2]
-    resp = lambda_client.get_function(FunctionName=f_name)
+    resp = _lambda().get_function(FunctionName=f_name)
     return str(resp['Configuration']['FunctionArn'])
 
-def get_snapshot_state(snapshot_id):
-    func_name = traceback.extract_stack(None, 2)[0][2]
 
+def get_invoked_function_arn(context=None):
+    # The invocation context already knows our arn. Tags live on the function
+    # itself, so drop any alias or version qualifier.
+    arn = getattr(context, 'invoked_function_arn', None)
+    if arn:
+        return ":".join(str(arn).split(":")[:7])
+
+    return get_function_arn(os.environ['AWS_LAMBDA_FUNCTION_NAME'])
+
+
+def get_remaining_time_millis(context=None):
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining:
+        return get_remaining()
+
+    return None
+
+def get_db_instance_state(instance_id):
+    try:
+        res = _rds().describe_db_instances(DBInstanceIdentifier=instance_id)
+    except ClientError as e:
+        return None
+    return get_instance_state(instance_id, RdsInventory.from_response(res))
+
+
+def get_snapshot_state(snapshot_id):
     try:
-        snapshot = client.describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)
-        logger.info(":{0} response for describe snapshot {1}".format(func_name, snapshot))
+        snapshot = _rds().describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)
+        logger.info("response for describe snapshot %s", _payload(snapshot))
         for ins in snapshot['DBSnapshots']:
             return ins['Status']
     
     except ClientError as e:
         return None
 
-def handler(event, context):
-    level = logging.getLevelName(os.environ['log_level'].rstrip().upper())
-    func_name = traceback.extract_stack(None, 2)[0][2]
+# Output fragments of recent requests, so that CloudFormation invoking the
+# macro again for the same change gets the same answer without repeating
+# any lookup or starting a second restore.
+idempotency_max_entries = 32
+idempotency_record_prefix = 'idempotency/'
+recorded_fragments = TTLCache(idempotency_max_entries, max_idempotency_window_seconds)
 
-    logger.info(':{0}:this is the event = {1}'.format(func_name, event))
-    do_not_skip_processing = True
-    try:
-        logger.setLevel(level)
-    except ValueError as ve:
-        print("Logger level is not  valid {0}".format(str(ve)))
-        do_not_skip_processing = False
 
-    fragment = event["fragment"]
-    params = event['params']
+def idempotency_key(stack_of_interest, fragment, config):
+    body = json.dumps([stack_of_interest, fragment, config._asdict()],
+                      sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+class IdempotentRequest(object):
+    # A request keyed on the stack, its input fragment and the config. The
+    # recorded output is kept in the container and, when the restore state
+    # store can hold it, in that store for the other containers.
+
+    def __init__(self, stack_of_interest, fragment, config, context=None, clock=time.time):
+        self.key = idempotency_key(stack_of_interest, fragment, config)
+        self.window_seconds = config.idempotency_window_seconds
+        self.store = get_restore_state_store(get_invoked_function_arn(context), config)
+        self._clock = clock
+
+    def recorded(self):
+        record = recorded_fragments.get(self.key)
+        if record is None:
+            try:
+                record = self.store.get_record(idempotency_record_prefix + self.key)
+            except Exception as e:
+                logger.warning("unable to read recorded fragment: %s", e)
+        if record is None or self._clock() >= record[0]:
+            return None
+        recorded_fragments.put(self.key, record)
+        return json.loads(record[1])
+
+    def record(self, fragment):
+        record = (self._clock() + self.window_seconds,
+                  json.dumps(fragment, separators=(',', ':'), default=str))
+        recorded_fragments.put(self.key, record)
+        try:
+            self.store.put_record(idempotency_record_prefix + self.key, *record)
+        except Exception as e:
+            logger.warning("unable to record fragment: %s", e)
+
+
+def get_idempotent_request(stack_of_interest, fragment, config, context=None):
+    if config is None or not config.idempotency_window_seconds:
+        return None
+    if config.restore_point_in_time and not config.replace_with_snapshot:
+        # Every request has to move a restore on. Each step is claimed in the
+        # restore state before it reaches rds, so a repeated request never
+        # starts a second restore, even when both arrive at once.
+        return None
     try:
-        stack_of_interest = params['stackname']
-    except:
-        raise Exception('stackname parameter was not defined in the macro')
+        return IdempotentRequest(stack_of_interest, fragment, config, context)
+    except Exception as e:
+        # Only saves repeating work, the request is transformed as usual.
+        logger.warning("unable to reach recorded fragments: %s", e)
+        return None
 
-    # This needs to be done first.
-    deployed_template = get_ugc_database_template(stack_of_interest)
-    status = "success"
-    logger.debug(':{0}:fragment_before_modification={1}'.format(
-        func_name, fragment))
 
+def transform_db_instance(fragment, stack_of_interest, deployed_template, inventory,
+                          config=None, context=None, prefetch=None,
+                          logical_id=ugc_database_logical_id, failures=None):
+    # Every rule for one db instance. Without a valid config the fragment is
+    # left as is, and on any error the deployed version is kept and the
+    # logical id added to failures.
+    logger.debug('fragment_before_modification=%s', _payload(fragment))
     try:
 
-        if do_not_skip_processing:
-            update_snapshot(fragment, stack_of_interest)
-            remove_properties(fragment)
-            add_properties(fragment)
+        if config is not None:
+            apply_fragment_ops(
+                fragment, get_fragment_ops(config),
+                resolve_snapshot_id(stack_of_interest, inventory, config, prefetch,
+                                    logical_id))
             fragment = point_in_time_restore(
-                fragment, stack_of_interest, deployed_template)
+                fragment, stack_of_interest, deployed_template, inventory, config,
+                context, prefetch, logical_id)
 
         snapshot_id = check_if_snapshot_identifier_needs_be_added(
             fragment, deployed_template)
     except:
         stack_trace = _format_stacktrace()
-        logger.error(":{0}:SOMETHING WENT WRONG:{1}".format(
-            func_name, stack_trace))
+        logger.error("SOMETHING WENT WRONG:%s", stack_trace)
+        if failures is not None:
+            failures.append(logical_id)
         if deployed_template:
-            fragment = json.loads(deployed_template)
+            # The deployed template is shared with the cache, never hand it out.
+            fragment = copy.deepcopy(deployed_template)
+
+    return fragment
+
+
+MacroRequest = namedtuple('MacroRequest', [
+    'stack_of_interest', 'fragment', 'config', 'idempotent', 'logical_ids',
+    'template_level'])
+
+
+def _begin_macro_request(event, context):
+    # Everything handler and async_handler do before transforming: the log
+    # context, the config and which db instances to transform.
+    logger.bind(requestId=event.get('requestId'),
+                stackname=event.get('params', {}).get('stackname'))
+    logger.info('this is the event = %s', _payload(event))
+    api_limiter.reset_counts()
+    config = None
+    try:
+        config = get_config()
+        logger.setLevel(config.log_level)
+    except MacroConfigError as e:
+        logger.error("configuration is not valid, fragment left as is: %s", e)
+
+    fragment = event["fragment"]
+    params = event['params']
+    try:
+        stack_of_interest = params['stackname']
+    except:
+        raise Exception('stackname parameter was not defined in the macro')
+
+    # Keyed before the fragment is changed in place.
+    idempotent = get_idempotent_request(stack_of_interest, fragment, config, context)
+
+    # A template level transform gets the whole template, every db instance
+    # in it is transformed with one inventory and one deployed template.
+    template_level = 'Resources' in fragment
+    if template_level:
+        logical_ids = [logical_id for logical_id, _ in iter_db_instance_resources(fragment)]
+    else:
+        logical_ids = [ugc_database_logical_id]
 
-    logger.info(":{0}:fragment_after_modification={1}".format(
-        func_name, fragment))
+    return MacroRequest(stack_of_interest, fragment, config, idempotent,
+                        logical_ids, template_level)
+
+
+def _recorded_response(event, request):
+    if request.idempotent is None:
+        return None
+    recorded = request.idempotent.recorded()
+    if recorded is None:
+        return None
+    logger.info("returning the fragment recorded for request %s", request.idempotent.key)
+    return _macro_response(event, recorded)
+
+
+def _end_macro_request(event, request, fragment, failures):
+    # A fallback to the deployed template is not an answer worth repeating.
+    if request.idempotent is not None and not failures:
+        request.idempotent.record(fragment)
+
+    logger.info("fragment_after_modification=%s", _payload(fragment))
+    log_api_calls()
+    return _macro_response(event, fragment)
+
+
+def _macro_response(event, fragment):
     return {
         "requestId": event["requestId"],
-        "status": status,
+        "status": "success",
         "fragment": fragment,
     }
+
+
+def handler(event, context):
+    if restore_poll_event_key in event:
+        return poll_restore_handler(event, context)
+
+    request = _begin_macro_request(event, context)
+    recorded = _recorded_response(event, request)
+    if recorded is not None:
+        return recorded
+
+    stack_of_interest = request.stack_of_interest
+    config = request.config
+    # Shared by every phase, only listed when a phase first needs it.
+    inventory = RdsInventory()
+    prefetch = HandlerPrefetch(stack_of_interest, inventory, config, context,
+                               request.logical_ids)
+
+    # This needs to be done first.
+    deployed_resources = prefetch.result(
+        'deployed_resources', get_deployed_resources, stack_of_interest)
+    failures = []
+
+    fragment = request.fragment
+    if request.template_level:
+        resources = fragment['Resources']
+        for logical_id in request.logical_ids:
+            resources[logical_id] = transform_db_instance(
+                resources[logical_id], stack_of_interest,
+                _deployed_resource(deployed_resources, logical_id), inventory,
+                config, context, prefetch, logical_id, failures)
+    else:
+        fragment = transform_db_instance(
+            fragment, stack_of_interest, _deployed_resource(deployed_resources),
+            inventory, config, context, prefetch, failures=failures)
+
+    return _end_macro_request(event, request, fragment, failures)
+
+
+class AsyncClients(object):
+    # The AWS calls of the asyncio pipeline. By default the boto3 clients run
+    # on the event loop's executor; an in-process fake, or a natively async
+    # client, only needs to provide call and paginate.
+
+    def __init__(self, provider=None):
+        self._provider = provider or clients
+
+    async def call(self, service_name, operation, **params):
+        method = getattr(self._provider.get(service_name), operation)
+        return await _run_sync(method, **params)
+
+    async def paginate(self, service_name, operation, **params):
+        paginator = self._provider.get(service_name).get_paginator(operation)
+        pages = iter(paginator.paginate(**params))
+        while True:
+            page = await _run_sync(next, pages, None)
+            if page is None:
+                return
+            yield page
+
+
+def _run_sync(fn, *args, **kwargs):
+    # asyncio is imported on first use, like boto3, to keep cold starts short.
+    import asyncio
+    return asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(fn, *args, **kwargs))
+
+
+class AsyncHandlerPrefetch(HandlerPrefetch):
+    # HandlerPrefetch with the deployed template and the snapshot listings
+    # requested on the event loop through the async clients. The steps of
+    # handler read them like any other prefetched result, from the executor
+    # threads they run on.
+
+    def __init__(self, aws, loop, *args):
+        self._aws = aws
+        self._loop = loop
+        self._on_loop = []
+        super(AsyncHandlerPrefetch, self).__init__(*args)
+
+    def _start(self, name, fn, *args):
+        import asyncio
+        kind = name[0] if isinstance(name, tuple) else name
+        if kind == 'deployed_resources':
+            coro = async_get_deployed_resources(self._aws, *args)
+        elif kind == 'latest_snapshot_arn':
+            coro = async_find_latest_snapshot_arn(self._aws, *args)
+        else:
+            return super(AsyncHandlerPrefetch, self)._start(name, fn, *args)
+        self._futures[name] = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        self._on_loop.append(self._futures[name])
+
+    async def settled(self):
+        # Waited for before any step runs, so that no executor thread blocks
+        # on a listing that itself needs an executor thread.
+        import asyncio
+        if self._on_loop:
+            await asyncio.wait([asyncio.wrap_future(f) for f in self._on_loop])
+
+
+async def _async_run_calls(calls, call):
+    # _run_calls for the asyncio pipeline, awaiting each call.
+    try:
+        request = next(calls)
+        while True:
+            try:
+                response = await call(*request)
+            except Exception as e:
+                request = calls.throw(e)
+            else:
+                request = calls.send(response)
+    except StopIteration as e:
+        return e.value
+
+
+async def async_get_deployed_resources(aws, stack_of_interest):
+    return await _async_run_calls(
+        _deployed_resources_calls(stack_of_interest),
+        lambda operation, params: aws.call('cloudformation', operation, **params))
+
+
+async def async_find_latest_snapshot_arn(aws, stackname, inventory, config,
+                                         logical_id=ugc_database_logical_id):
+    # The instance is found as in find_latest_snapshot_arn, on the prefetch
+    # executor that the steps waiting on this result never occupy.
+    import asyncio
+    db_instance = await asyncio.wrap_future(_get_prefetch_executor().submit(
+        find_stack_db_instance, stackname, inventory, config, logical_id))
+    logger.debug("creating snapshot for db_instance = [%s]", db_instance)
+    if not db_instance:
+        return None
+
+    params = {'DBInstanceIdentifier': db_instance}
+    if config.snapshot_type:
+        params['SnapshotType'] = config.snapshot_type
+    latest = None
+    async for page in aws.paginate('rds', 'describe_db_snapshots', **params):
+        candidates = page['DBSnapshots'] + ([latest] if latest else [])
+        latest = select_latest_snapshot(candidates)
+    if latest:
+        return latest['DBSnapshotArn']
+
+    return None
+
+
+async def async_handler(event, context, aws=None):
+    # The steps of handler, each db instance on an executor thread, with the
+    # deployed template and the snapshot listings requested on the event
+    # loop. The db instances of a template level transform run side by side.
+    # Only those listings go through aws; the restore steps and the instance
+    # lookups are the sync code of handler, run on the executor threads.
+    import asyncio
+    if restore_poll_event_key in event:
+        return await _run_sync(poll_restore_handler, event, context)
+
+    aws = aws or AsyncClients()
+    request = await _run_sync(_begin_macro_request, event, context)
+    recorded = await _run_sync(_recorded_response, event, request)
+    if recorded is not None:
+        return recorded
+
+    stack_of_interest = request.stack_of_interest
+    config = request.config
+    logical_ids = request.logical_ids
+    inventory = RdsInventory()
+    prefetch = await _run_sync(
+        AsyncHandlerPrefetch, aws, asyncio.get_event_loop(), stack_of_interest,
+        inventory, config, context, logical_ids)
+    await prefetch.settled()
+    deployed_resources = await _run_sync(
+        prefetch.result, 'deployed_resources', get_deployed_resources, stack_of_interest)
+    failures = []
+
+    fragment = request.fragment
+    if request.template_level:
+        db_instances = fragment['Resources']
+        transformed = await asyncio.gather(*[
+            _run_sync(transform_db_instance, db_instances[logical_id], stack_of_interest,
+                      _deployed_resource(deployed_resources, logical_id), inventory,
+                      config, context, prefetch, logical_id, failures)
+            for logical_id in logical_ids])
+        db_instances.update(zip(logical_ids, transformed))
+    else:
+        fragment = await _run_sync(
+            transform_db_instance, fragment, stack_of_interest,
+            _deployed_resource(deployed_resources), inventory, config, context,
+            prefetch, failures=failures)
+
+    return await _run_sync(_end_macro_request, event, request, fragment, failures)
+
+
+def asyncio_handler(event, context):
+    # Lambda entry point for async_handler, one event loop per invocation.
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(async_handler(event, context))
+    finally:
+        loop.close()
+
+
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    # Fail the cold start, not a stack update, when the lambda is misconfigured.
+    get_config()
@@ -0,0 +1,661 @@
+"""Micro benchmarks for the rds macro hot paths.
+
+Run from the src directory:
+
+    PYTHONPATH=. python tests/bench_ugc_rds_macro.py
+
+Each benchmark prints one json object per line, a list of names runs only
+those benchmarks. With --output FILE the same lines are appended to FILE,
+each tagged with the commit, python version and time of the run, so that
+results can be compared over time:
+
+    PYTHONPATH=. python tests/bench_ugc_rds_macro.py --output bench.jsonl bench_sizes
+"""
+import copy
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+import timeit
+import traceback
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+
+import lambdas.ugc_rds_macro
+from lambdas.ugc_rds_macro import (RdsInventory, StackInstanceResolver,
+                                   apply_fragment_ops, find_latest_snapshot_arn,
+                                   get_config, get_fragment_ops,
+                                   get_snapshot_identifier, handler,
+                                   parse_db_identifier, point_in_time_restore)
+
+_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class BenchContext:
+    invoked_function_arn = "arn:aws:lambda:eu-west-2:546933502184:function:int-ugc-rds-macro"
+    function_name = "func-name"
+
+
+bench_context = BenchContext()
+
+
+def _random_suffix(rnd, length=13):
+    return ''.join(rnd.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+
+def make_instances(count, seed=1):
+    rnd = random.Random(seed)
+    instances = []
+    for i in range(count):
+        stack = "stack-{0:05d}-rds-db".format(i)
+        instances.append({
+            'DBInstanceIdentifier': "{0}-{1}".format(stack, _random_suffix(rnd, 6)),
+            'DBInstanceStatus': 'available',
+            'BackupRetentionPeriod': 7,
+            'DBSubnetGroup': {
+                'DBSubnetGroupName': "{0}-subnetgroup-{1}".format(stack, _random_suffix(rnd)),
+            },
+        })
+    rnd.shuffle(instances)
+    return instances
+
+
+def make_template(size_bytes):
+    # The UGCDatabase fixture padded with tags until it is about size_bytes.
+    with open(os.path.join(_dir, 'test_files', 'db_instance_template.json')) as f:
+        template = json.load(f)
+    tags = template['Properties'].setdefault('Tags', [])
+    tag_size = len(json.dumps({'Key': 'tag-00000000', 'Value': 'v' * 64}))
+    for i in range(max(0, size_bytes // tag_size)):
+        tags.append({'Key': 'tag-{0:08d}'.format(i), 'Value': 'v' * 64})
+    return template
+
+
+def _pure_transform_env():
+    for key, value in (('log_level', 'info'),
+                       ('replace_with_snapshot', 'false'),
+                       ('snapshot_id', ''),
+                       ('snapshot_type', ''),
+                       ('properties_to_remove', 'BackupRetentionPeriod'),
+                       ('properties_to_add', '{"DBName": "bench"}'),
+                       ('rds_snapshot_stack_name', ''),
+                       ('restore_time', ''),
+                       ('restore_point_in_time', '')):
+        os.environ[key] = value
+    lambdas.ugc_rds_macro.do_not_ignore_get_template = False
+
+
+def _linear_scan(response, key):
+    # The original parse_db_identifier, kept here as the baseline.
+    found = None
+    for item in response['DBInstances']:
+        for k, v in item.items():
+            if str(k) in str('DBInstanceIdentifier'):
+                db_inst_id = str(v)
+
+            if str(k) == str('DBSubnetGroup'):
+                if str(v['DBSubnetGroupName']).startswith(key):
+                    db_instance_id = db_inst_id
+                    found = True
+
+    if found:
+        return db_instance_id
+
+    return found
+
+
+def _best_of(stmt, number, repeat=5):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def bench_resolver(count=10000, lookups=100):
+    response = {'DBInstances': make_instances(count)}
+    keys = ["stack-{0:05d}-rds-db".format(i) for i in range(0, count, max(1, count // lookups))]
+    inventory = RdsInventory.from_response(response)
+
+    def scan():
+        for key in keys:
+            _linear_scan(response, key)
+
+    def indexed():
+        resolver = inventory.resolver()
+        for key in keys:
+            resolver.resolve(key)
+
+    def build():
+        StackInstanceResolver(response['DBInstances'])
+
+    for key in keys:
+        assert parse_db_identifier(inventory, key) == _linear_scan(response, key)
+
+    return {
+        'benchmark': 'resolver',
+        'instances': count,
+        'lookups': len(keys),
+        'linear_scan_s': _best_of(scan, 1),
+        'index_build_s': _best_of(build, 1),
+        'indexed_lookups_s': _best_of(indexed, 10),
+    }
+
+
+def bench_logging(size_bytes=4 * 1024 * 1024):
+    # Compares the handler at INFO with the same handler also doing the
+    # formatting it used to do eagerly, whatever the log level.
+    _pure_transform_env()
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    root.setLevel(logging.INFO)
+    template = make_template(size_bytes)
+
+    def event():
+        return {'fragment': copy.deepcopy(template), 'requestId': 'bench',
+                'params': {'stackname': 'bench-rds-db-stack'}}
+
+    def eager_formatting(e):
+        fragment = e['fragment']
+        ':{0}:this is the event = {1}'.format('handler', e)
+        ':{0}:fragment_before_modification={1}'.format('handler', fragment)
+        ':{0}:{1}'.format('get_snapshot_identifier', str(json.dumps(fragment)))
+        ':{0}:{1}'.format('get_snapshot_identifier', str(json.dumps(fragment)))
+        ':{0}:fragment_after_modification={1}'.format('handler', fragment)
+
+    def eager_handler(e):
+        eager_formatting(e)
+        return handler(e, bench_context)
+
+    events = [event() for _ in range(3)]
+    handler_s = min(timeit.repeat(lambda: handler(events.pop(), bench_context),
+                                  number=1, repeat=3))
+    events = [event() for _ in range(3)]
+    handler_before_s = min(timeit.repeat(lambda: eager_handler(events.pop()),
+                                         number=1, repeat=3))
+    return {
+        'benchmark': 'logging',
+        'template_bytes': len(json.dumps(template)),
+        'handler_s': handler_s,
+        'handler_before_s': handler_before_s,
+    }
+
+
+# Functions that used to call traceback.extract_stack on every call.
+_INTROSPECTING_FUNCTIONS = set([
+    'check_if_snapshot_identifier_needs_be_added', 'get_ugc_database_template',
+    'get_snapshot_identifier', 'get_instance_state',
+    'point_in_time_restore', 'check_if_point_in_time_date_is_valid',
+    'delete_db_instance', 'get_function_arn', 'get_snapshot_state', 'handler'])
+
+
+def _count_introspecting_calls(func):
+    module_file = lambdas.ugc_rds_macro.__file__
+    calls = [0]
+
+    def profile(frame, event, arg):
+        if (event == 'call' and frame.f_code.co_filename == module_file
+                and frame.f_code.co_name in _INTROSPECTING_FUNCTIONS):
+            calls[0] += 1
+
+    sys.setprofile(profile)
+    try:
+        func()
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+
+def _with_stack_introspection(func):
+    # Runs func with each introspecting function extracting the stack on
+    # entry again, as the handler used to.
+    macro = lambdas.ugc_rds_macro
+    saved = {}
+
+    def introspecting(original):
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            traceback.extract_stack(None, 2)[0][2]
+            return original(*args, **kwargs)
+        return wrapper
+
+    for name in _INTROSPECTING_FUNCTIONS:
+        original = getattr(macro, name, None)
+        if callable(original):
+            saved[name] = original
+            setattr(macro, name, introspecting(original))
+    try:
+        return func()
+    finally:
+        for name, original in saved.items():
+            setattr(macro, name, original)
+
+
+def bench_function_context(number=2000):
+    # Handler overhead on a small template, against the same handler with
+    # the removed per-call stack introspection put back.
+    _pure_transform_env()
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    root.setLevel(logging.INFO)
+    template = make_template(0)
+
+    def run():
+        # Through the module, so that the handler is introspecting too.
+        lambdas.ugc_rds_macro.handler(
+            {'fragment': copy.deepcopy(template), 'requestId': 'bench',
+             'params': {'stackname': 'bench-rds-db-stack'}}, bench_context)
+
+    def frame():
+        traceback.extract_stack(None, 2)[0][2]
+
+    calls = _count_introspecting_calls(run)
+    return {
+        'benchmark': 'function_context',
+        'handler_s': _best_of(run, number),
+        'introspecting_calls': calls,
+        'extract_stack_per_call_s': _best_of(frame, number),
+        'handler_before_s': _with_stack_introspection(lambda: _best_of(run, number)),
+    }
+
+
+_COLD_START_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import lambdas.ugc_rds_macro as macro
+imported = time.perf_counter()
+boto3_on_import = 'boto3' in sys.modules
+macro.clients.get('cloudformation')
+first_client = time.perf_counter()
+macro.clients.get('rds')
+macro.clients.get('lambda')
+all_clients = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - start,
+    'boto3_imported_on_import': boto3_on_import,
+    'cloudformation_client_s': first_client - imported,
+    'remaining_clients_s': all_clients - first_client,
+}))
+'''
+
+
+def bench_cold_start(runs=5):
+    # Every run is a fresh interpreter, as in a new Lambda container.
+    src = os.path.dirname(_dir)
+    env = dict(os.environ, PYTHONPATH=src, PYTHONDONTWRITEBYTECODE='1')
+    samples = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _COLD_START_SCRIPT], cwd=src, env=env)
+        samples.append(json.loads(out.decode('utf-8')))
+
+    result = {'benchmark': 'cold_start', 'runs': runs}
+    for key in ('import_s', 'cloudformation_client_s', 'remaining_clients_s'):
+        result[key] = min(sample[key] for sample in samples)
+    result['boto3_imported_on_import'] = samples[0]['boto3_imported_on_import']
+    return result
+
+
+class _LatencyClient(object):
+    # Answers the calls a point in time restore starts with, each after a
+    # fixed delay standing in for the AWS round trip.
+
+    def __init__(self, latency_s, instances):
+        self.latency_s = latency_s
+        self.instances = instances
+
+    def describe_stacks(self, StackName):
+        time.sleep(self.latency_s)
+        return {'Stacks': [{'CreationTime': 'bench-{0}'.format(time.time())}]}
+
+    def get_template(self, StackName, TemplateStage):
+        time.sleep(self.latency_s)
+        return {'TemplateBody': {'Resources': {'UGCDatabase': make_template(0)}}}
+
+    def list_tags(self, Resource):
+        time.sleep(self.latency_s)
+        return {'Tags': {}}
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self):
+                time.sleep(client.latency_s)
+                return [{'DBInstances': client.instances}]
+        return Paginator()
+
+    def restore_db_instance_to_point_in_time(self, **kwargs):
+        time.sleep(self.latency_s)
+        return {'DBInstance': {'DBInstanceStatus': 'creating'}}
+
+    def tag_resource(self, Resource, Tags):
+        time.sleep(self.latency_s)
+        return {}
+
+
+def bench_prefetch(latency_s=0.05, runs=5):
+    # A point in time restore starting on a stack, with and without the
+    # independent calls prefetched side by side.
+    _pure_transform_env()
+    os.environ['restore_point_in_time'] = 'true'
+    os.environ['resolve_from_stack_resources'] = 'false'
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    root.setLevel(logging.INFO)
+    macro = lambdas.ugc_rds_macro
+    fake = _LatencyClient(latency_s, make_instances(100) + [{
+        'DBInstanceIdentifier': 'bench-ugc-postgres', 'DBInstanceStatus': 'available',
+        'BackupRetentionPeriod': 7,
+        'DBSubnetGroup': {'DBSubnetGroupName': 'bench-rds-db-stack-subnetgroup-x'}}])
+    saved = (macro._rds, macro._cloudformation, macro._lambda,
+             macro.prefetch_max_workers, macro.do_not_ignore_get_template)
+    macro._rds = macro._cloudformation = macro._lambda = lambda: fake
+    macro.do_not_ignore_get_template = True
+
+    def run():
+        handler({'fragment': make_template(0), 'requestId': 'bench',
+                 'params': {'stackname': 'bench-rds-db-stack'}}, bench_context)
+
+    result = {'benchmark': 'prefetch', 'latency_s': latency_s}
+    try:
+        for name, workers in (('sequential_s', 0), ('prefetch_s', saved[3] or 4)):
+            macro.prefetch_max_workers = workers
+            result[name] = min(timeit.repeat(run, number=1, repeat=runs))
+    finally:
+        (macro._rds, macro._cloudformation, macro._lambda,
+         macro.prefetch_max_workers, macro.do_not_ignore_get_template) = saved
+        os.environ['restore_point_in_time'] = ''
+        os.environ['resolve_from_stack_resources'] = ''
+    return result
+
+
+INVENTORY_SIZES = (10, 1000, 10000)
+SNAPSHOT_COUNTS = (10, 1000, 10000)
+TEMPLATE_BYTES = (16 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+
+def make_snapshots(db_instance, count, seed=1):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2019, 1, 1)
+    snapshots = []
+    for i in range(count):
+        created = start + datetime.timedelta(minutes=rnd.randrange(count * 60))
+        snapshots.append({
+            'DBSnapshotIdentifier': "rds:{0}-{1:05d}".format(db_instance, i),
+            'DBSnapshotArn': "arn:aws:rds:eu-west-2:546933502184:snapshot:rds:{0}-{1:05d}".format(
+                db_instance, i),
+            'DBInstanceIdentifier': db_instance,
+            'SnapshotCreateTime': created,
+            'Status': 'available' if i % 10 else 'creating',
+        })
+    return snapshots
+
+
+class _SnapshotClient(object):
+    # Pages snapshots 100 at a time, as describe_db_snapshots does.
+
+    def __init__(self, snapshots, page_size=100):
+        self.pages = [{'DBSnapshots': snapshots[i:i + page_size]}
+                      for i in range(0, len(snapshots), page_size)] or [{'DBSnapshots': []}]
+
+    def get_paginator(self, name):
+        pages = self.pages
+
+        class Paginator(object):
+            def paginate(self, **params):
+                return iter(pages)
+        return Paginator()
+
+
+class _InventoryClient(_SnapshotClient):
+    # Also pages the db instances 100 at a time, as describe_db_instances does.
+
+    def __init__(self, instances, snapshots, page_size=100):
+        super(_InventoryClient, self).__init__(snapshots, page_size)
+        self.instance_pages = [{'DBInstances': instances[i:i + page_size]}
+                               for i in range(0, len(instances), page_size)]
+
+    def get_paginator(self, name):
+        if name != 'describe_db_instances':
+            return super(_InventoryClient, self).get_paginator(name)
+        pages = self.instance_pages
+
+        class Paginator(object):
+            def paginate(self, **params):
+                return iter(pages)
+        return Paginator()
+
+
+def _quiet_logging():
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    root.setLevel(logging.INFO)
+
+
+def _inventory_stack(count):
+    return "stack-{0:05d}-rds-db".format(count // 2)
+
+
+def bench_inventory_sizes(sizes=INVENTORY_SIZES, lookups=100):
+    results = []
+    for count in sizes:
+        response = {'DBInstances': make_instances(count)}
+        keys = ["stack-{0:05d}-rds-db".format(i)
+                for i in range(0, count, max(1, count // lookups))]
+
+        def index_and_resolve():
+            inventory = RdsInventory.from_response(response)
+            for key in keys:
+                parse_db_identifier(inventory, key)
+
+        inventory = RdsInventory.from_response(response)
+        inventory.resolver()
+
+        def resolve():
+            for key in keys:
+                parse_db_identifier(inventory, key)
+
+        results.append({
+            'benchmark': 'parse_db_identifier',
+            'instances': count,
+            'lookups': len(keys),
+            'first_lookup_s': _best_of(index_and_resolve, 1) / len(keys),
+            'lookup_s': _best_of(resolve, 10) / len(keys),
+        })
+    return results
+
+
+def bench_snapshot_counts(counts=SNAPSHOT_COUNTS):
+    _pure_transform_env()
+    os.environ['replace_with_snapshot'] = 'true'
+    os.environ['resolve_from_stack_resources'] = 'false'
+    macro = lambdas.ugc_rds_macro
+    inventory = RdsInventory(make_instances(100))
+    stack = _inventory_stack(100)
+    db_instance = parse_db_identifier(inventory, stack)
+    saved = macro._rds
+    results = []
+    try:
+        config = get_config()
+        for count in counts:
+            fake = _SnapshotClient(make_snapshots(db_instance, count))
+            macro._rds = lambda: fake
+            results.append({
+                'benchmark': 'find_latest_snapshot_arn',
+                'snapshots': count,
+                'find_s': _best_of(
+                    lambda: find_latest_snapshot_arn(stack, inventory, config), 5),
+            })
+    finally:
+        macro._rds = saved
+        os.environ['replace_with_snapshot'] = 'false'
+        os.environ['resolve_from_stack_resources'] = ''
+    return results
+
+
+def bench_template_sizes(sizes=TEMPLATE_BYTES):
+    _pure_transform_env()
+    _quiet_logging()
+    config = get_config()
+    results = []
+    for size_bytes in sizes:
+        template = make_template(size_bytes)
+        template['Properties']['DBSnapshotIdentifier'] = 'snap'
+        number = max(1, (256 * 1024) // size_bytes)
+        copies = [copy.deepcopy(template) for _ in range(3 * number)]
+
+        def edit():
+            apply_fragment_ops(copies.pop(), get_fragment_ops(config))
+
+        def run_handler():
+            handler({'fragment': copies.pop(), 'requestId': 'bench',
+                     'params': {'stackname': 'bench-rds-db-stack'}}, bench_context)
+
+        result = {
+            'benchmark': 'template_size',
+            'template_bytes': len(json.dumps(template)),
+            'get_snapshot_identifier_s': _best_of(
+                lambda: get_snapshot_identifier(template), number * 100),
+            'get_snapshot_identifier_json_s': _best_of(
+                lambda: get_snapshot_identifier(json.dumps(template)), number, repeat=3),
+            'add_remove_properties_s': _best_of(edit, number, repeat=3),
+        }
+        copies = [copy.deepcopy(template) for _ in range(3 * number)]
+        result['handler_s'] = _best_of(run_handler, number, repeat=3)
+        results.append(result)
+    return results
+
+
+def bench_handler_inventory_sizes(sizes=INVENTORY_SIZES, snapshots=100):
+    # The whole handler replacing a db instance with its latest snapshot:
+    # listing the inventory, resolving the stack's instance in it and
+    # finding the snapshot, against in-memory AWS.
+    _pure_transform_env()
+    os.environ['replace_with_snapshot'] = 'true'
+    os.environ['resolve_from_stack_resources'] = 'false'
+    _quiet_logging()
+    macro = lambdas.ugc_rds_macro
+    saved = macro._rds
+    results = []
+    try:
+        for count in sizes:
+            instances = make_instances(count)
+            stack = _inventory_stack(count)
+            db_instance = parse_db_identifier(RdsInventory(instances), stack)
+            fake = _InventoryClient(instances, make_snapshots(db_instance, snapshots))
+            macro._rds = lambda: fake
+
+            def run():
+                return handler({'fragment': make_template(0), 'requestId': 'bench',
+                                'params': {'stackname': stack}}, bench_context)
+
+            assert 'DBSnapshotIdentifier' in run()['fragment']['Properties']
+            results.append({
+                'benchmark': 'handler_inventory_size',
+                'instances': count,
+                'snapshots': snapshots,
+                'handler_s': _best_of(run, 1),
+            })
+    finally:
+        macro._rds = saved
+        os.environ['replace_with_snapshot'] = 'false'
+        os.environ['resolve_from_stack_resources'] = ''
+    return results
+
+
+def bench_point_in_time_restore(sizes=INVENTORY_SIZES):
+    # Starting a restore: resolving the stack's instance in the inventory,
+    # the restore call and the state write, against in-memory AWS.
+    _pure_transform_env()
+    os.environ['restore_point_in_time'] = 'true'
+    os.environ['resolve_from_stack_resources'] = 'false'
+    _quiet_logging()
+    macro = lambdas.ugc_rds_macro
+    saved = (macro._rds, macro._lambda)
+    results = []
+    try:
+        config = get_config()
+        for count in sizes:
+            instances = make_instances(count)
+            fake = _LatencyClient(0, instances)
+            macro._rds = macro._lambda = lambda: fake
+            stack = _inventory_stack(count)
+
+            def restore():
+                point_in_time_restore(make_template(0), stack, None,
+                                      RdsInventory(instances), config, bench_context)
+
+            results.append({
+                'benchmark': 'point_in_time_restore',
+                'instances': count,
+                'start_restore_s': _best_of(restore, 5),
+            })
+    finally:
+        macro._rds, macro._lambda = saved
+        os.environ['restore_point_in_time'] = ''
+        os.environ['resolve_from_stack_resources'] = ''
+    return results
+
+
+def bench_sizes():
+    # The size dependent benchmarks together, for tracking over time.
+    results = []
+    for bench in (bench_inventory_sizes, bench_snapshot_counts,
+                  bench_template_sizes, bench_handler_inventory_sizes,
+                  bench_point_in_time_restore):
+        results.extend(bench())
+    return results
+
+
+BENCHMARKS = [bench_resolver, bench_logging, bench_function_context,
+              bench_cold_start, bench_prefetch, bench_inventory_sizes,
+              bench_snapshot_counts, bench_template_sizes,
+              bench_handler_inventory_sizes, bench_point_in_time_restore,
+              bench_sizes]
+
+# Run when no benchmark is named; bench_sizes repeats the ones above it.
+DEFAULT_BENCHMARKS = BENCHMARKS[:-1]
+
+
+def run_metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=_dir,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'run_at': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+    }
+
+
+def main(argv):
+    args = argv[1:]
+    output = None
+    if '--output' in args:
+        i = args.index('--output')
+        output = args[i + 1]
+        del args[i:i + 2]
+
+    metadata = run_metadata() if output else None
+    for bench in (BENCHMARKS if args else DEFAULT_BENCHMARKS):
+        if args and bench.__name__ not in args:
+            continue
+        results = bench()
+        for result in (results if isinstance(results, list) else [results]):
+            line = json.dumps(result, sort_keys=True)
+            print(line)
+            if output:
+                result = dict(result, **metadata)
+                with open(output, 'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
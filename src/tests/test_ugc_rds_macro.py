@@ -1,30 +1,49 @@
+import asyncio
 import datetime
 import fnmatch
 import json
+import logging
 import os
+import threading
 import time
 import uuid
 from io import StringIO
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import py
 import pytest
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 from pytest_mock import mocker
 
 from datetime import datetime, timedelta, timezone
 
 import lambdas.ugc_rds_macro
-from lambdas.ugc_rds_macro import (_add_snapshot_identifier, _remove_property,
-                                   add_tag,
-                                   check_if_point_in_time_date_is_valid,
+from lambdas.ugc_rds_macro import (check_if_point_in_time_date_is_valid,
                                    get_instance_state, get_snapshot_identifier,
-                                   get_tagged_db_instance,
                                    get_ugc_database_template, handler,
                                    get_back_retention_period,
-                                   parse_db_identifier, remove_tag,
+                                   parse_db_identifier,
                                    delete_db_instance, get_function_arn,
-                                   get_snapshot_state)
+                                   get_snapshot_state, RdsInventory,
+                                   find_stack_db_instance, iter_db_snapshots,
+                                   select_latest_snapshot, TTLCache,
+                                   invalidate_deployed_template, _payload,
+                                   ClientProvider, MacroConfig, MacroConfigError,
+                                   get_config, get_invoked_function_arn,
+                                   get_remaining_time_millis, RestoreState,
+                                   read_restore_state, write_restore_state,
+                                   RestoreStateConflict, SqliteStateStore,
+                                   DynamoDbStateStore, get_restore_state_store,
+                                   LambdaTagStateStore, restore_state_tag_keys,
+                                   point_in_time_restore, async_handler,
+                                   asyncio_handler, restore_scope,
+                                   apply_fragment_ops, get_fragment_ops,
+                                   idempotency_key, get_idempotent_request,
+                                   poll_restore, restore_max_handovers,
+                                   get_deployed_resources, async_get_deployed_resources,
+                                   ApiCallLimiter, TokenBucket)
 
 _dir = os.path.dirname(os.path.realpath(__file__))
 FIXTURE_DIR = py.path.local(_dir) / 'test_files'
@@ -41,7 +60,8 @@ test_context = TestContext()
 # issue has been raise on git: https://github.com/boto/botocore/issues/1911
 lambdas.ugc_rds_macro.do_not_ignore_get_template = False
 
-lambdas.ugc_rds_macro.point_in_time_db_instance_tag
+# Restore state tag keys of the stack the point in time tests restore.
+dv_instance_tag, dv_snapshot_tag = restore_state_tag_keys('dv-rds-database-stack')
 
 def _read_test_data(datafiles, expected_file, orig_template):
     for testFile in datafiles.listdir():
@@ -105,7 +125,7 @@ def _mock_describe_db_instances(rds_stub, datafiles, id, state):
     )
 
 
-def _mock_add_tag(lambda_stub, tag, id):
+def _mock_add_tag(lambda_stub, tag, id, status="creating"):
     response = {'ResponseMetadata':
                 {'RequestId': 'c48d99c2-704b-4d51-adc1-93d64eb60f2c',
                  'HTTPStatusCode': 204,
@@ -120,7 +140,7 @@ def _mock_add_tag(lambda_stub, tag, id):
     lambda_stub.add_response(
         "tag_resource",
         expected_params={'Resource': test_context.invoked_function_arn,
-                         'Tags': {tag: "{0}:{1}".format(id, "creating")}},
+                         'Tags': {tag: "{0}:{1}".format(id, status)}},
         service_response=response
     )
 
@@ -267,7 +287,8 @@ def test_handler_add_multiple_properties(monkeypatch, datafiles):
     FIXTURE_DIR / 'db_instance_template_with_snapshot_specified.json',
     FIXTURE_DIR / 'db_describe_instance_response.json'
 )
-def test_snapshot_identifer(rds_stub, monkeypatch, datafiles):
+@pytest.mark.parametrize('run_handler', [handler, asyncio_handler])
+def test_snapshot_identifer(rds_stub, monkeypatch, datafiles, run_handler):
 
     monkeypatch.setenv("properties_to_remove", "BackupRetentionPeriod")
     monkeypatch.setenv("replace_with_snapshot", "true")
@@ -296,7 +317,7 @@ def test_snapshot_identifer(rds_stub, monkeypatch, datafiles):
     f = {'fragment': db_instance_template,
          'requestId': 'my_request_id', 'params': i}
 
-    res = handler(f, test_context)
+    res = run_handler(f, test_context)
     assert res['requestId'] == "my_request_id"
     print("frag={0}".format(res['fragment']))
     assert res['fragment'] == expected
@@ -356,8 +377,8 @@ def test_snapshot_identifer_with_invalid_snapshot_type(rds_stub, monkeypatch, da
     monkeypatch.setenv("snapshot_type", "invalid_snapshot_type")
     monkeypatch.setenv("restore_time", "")
     monkeypatch.setenv("restore_point_in_time", "")
-   
-    _mock_describe_db_instances(rds_stub,  datafiles, None, None)
+
+    # The configuration is rejected before any instance lookup.
 
     (expected, db_instance_template) = _read_test_data(datafiles,
                                                        "db_instance_template.json",
@@ -399,6 +420,113 @@ def test_snapshot_with_supplied_identifier(rds_stub, monkeypatch, datafiles):
     assert res['fragment'] == expected
 
 
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_instance_template.json',
+    FIXTURE_DIR / 'db_instance_template_with_snapshot_specified.json',
+    FIXTURE_DIR / 'db_describe_instance_response.json'
+)
+@pytest.mark.parametrize('run_handler', [handler, asyncio_handler])
+def test_repeated_request_returns_the_recorded_fragment(rds_stub, monkeypatch, datafiles, tmpdir, run_handler):
+
+    monkeypatch.setenv("properties_to_remove", "BackupRetentionPeriod")
+    monkeypatch.setenv("replace_with_snapshot", "true")
+    monkeypatch.setenv("snapshot_id", "")
+    monkeypatch.setenv("properties_to_add", "")
+    monkeypatch.setenv("rds_snapshot_stack_name", "mv-rds-db-stack")
+    monkeypatch.setenv("snapshot_type", "")
+    monkeypatch.setenv("restore_time", "")
+    monkeypatch.setenv("restore_point_in_time", "")
+    monkeypatch.setenv("restore_state_store", "sqlite")
+    monkeypatch.setenv("restore_state_path", str(tmpdir.join('state.db')))
+    monkeypatch.setenv("idempotency_window_seconds", "300")
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'recorded_fragments', TTLCache(32, 3600))
+
+    # Only the first request looks up the snapshot.
+    _mock_describe_db_instances(rds_stub, datafiles, None, None)
+    rds_stub.add_response(
+        'describe_db_snapshots',
+        expected_params={'DBInstanceIdentifier': 'mr1qf4ez7ls7xfn'},
+        service_response={'DBSnapshots': [{
+            'DBSnapshotArn': 'arn:aws:rds:eu-west-2:546933502184:snapshot:rds:mv-ugc-postgres-2019-12-06-11-10',
+            'Status': 'available', 'SnapshotCreateTime': datetime(2019, 12, 6, 11, 10, 33)}]})
+
+    (expected, db_instance_template) = _read_test_data(datafiles,
+                                                       "db_instance_template_with_snapshot_specified.json",
+                                                       "db_instance_template.json")
+
+    def request():
+        return {'fragment': json.loads(json.dumps(db_instance_template)),
+                'requestId': 'my_request_id', 'params': {'stackname': 'one-rds-db-stack'}}
+
+    assert run_handler(request(), test_context)['fragment'] == expected
+    assert run_handler(request(), test_context)['fragment'] == expected
+    # Another container finds the record in the restore state store.
+    lambdas.ugc_rds_macro.recorded_fragments.invalidate()
+    assert run_handler(request(), test_context)['fragment'] == expected
+
+    config = get_config()
+    assert idempotency_key('one-rds-db-stack', db_instance_template, config) != \
+        idempotency_key('two-rds-db-stack', db_instance_template, config)
+    assert idempotency_key('one-rds-db-stack', db_instance_template, config) != \
+        idempotency_key('one-rds-db-stack', db_instance_template,
+                        config._replace(snapshot_type='manual'))
+    # A point in time restore is moved on by every request instead.
+    assert get_idempotent_request('one-rds-db-stack', db_instance_template, config._replace(
+        replace_with_snapshot=False, restore_point_in_time=True), test_context) is None
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_instance_template.json',
+    FIXTURE_DIR / 'db_instance_template_with_supplied_snapshot_identifier.json'
+)
+@pytest.mark.parametrize('run_handler', [handler, asyncio_handler])
+def test_template_level_transform_updates_every_db_instance(monkeypatch, datafiles, run_handler):
+
+    monkeypatch.setenv("properties_to_remove", "BackupRetentionPeriod")
+    monkeypatch.setenv("replace_with_snapshot", "true")
+    monkeypatch.setenv("snapshot_id", "arn:aws:rds:eu-west-2:546933502184:snapshot:rds:mv-ugc-postgres-2019-12-06-11-10")
+    monkeypatch.setenv("properties_to_add", "")
+    monkeypatch.setenv("rds_snapshot_stack_name", "")
+    monkeypatch.setenv("snapshot_type", "")
+    monkeypatch.setenv("restore_time", "")
+    monkeypatch.setenv("restore_point_in_time", "")
+
+    (expected, db_instance_template) = _read_test_data(datafiles,
+                                                       "db_instance_template_with_supplied_snapshot_identifier.json",
+                                                       "db_instance_template.json")
+    bucket = {'Type': 'AWS::S3::Bucket', 'Properties': {'BucketName': 'ugc'}}
+    template = {'AWSTemplateFormatVersion': '2010-09-09',
+                'Resources': {'UGCDatabase': db_instance_template,
+                              'ReportingDatabase': json.loads(json.dumps(db_instance_template)),
+                              'Uploads': bucket}}
+
+    i = {'stackname': 'one-rds-db-stack'}
+    f = {'fragment': template, 'requestId': 'my_request_id', 'params': i}
+
+    res = run_handler(f, test_context)
+    resources = res['fragment']['Resources']
+    assert resources['UGCDatabase'] == expected
+    assert resources['ReportingDatabase'] == expected
+    assert resources['Uploads'] == {'Type': 'AWS::S3::Bucket',
+                                    'Properties': {'BucketName': 'ugc'}}
+
+
+def test_other_db_instances_are_only_found_through_stack_resources(rds_stub, cloudformation_stub, monkeypatch):
+    monkeypatch.setenv("resolve_from_stack_resources", "false")
+    cloudformation_stub.add_client_error(
+        'describe_stack_resource', service_error_code='ValidationError',
+        expected_params={'StackName': 'one-rds-db-stack',
+                         'LogicalResourceId': 'ReportingDatabase'})
+    inventory = RdsInventory([{'DBInstanceIdentifier': 'one-ugc-postgres',
+                               'DBSubnetGroup': {'DBSubnetGroupName': 'one-rds-db-stack-subnetgroup-x'}}])
+
+    # The subnet group belongs to the stack's UGCDatabase, not to this one.
+    assert find_stack_db_instance('one-rds-db-stack', inventory,
+                                  logical_id='ReportingDatabase') is None
+    assert restore_scope('one-rds-db-stack') == 'one-rds-db-stack'
+    assert restore_scope('one-rds-db-stack', 'ReportingDatabase') == 'one-rds-db-stack:ReportingDatabase'
+
+
 @pytest.mark.datafiles(
     FIXTURE_DIR / 'db_instance_template.json',
     FIXTURE_DIR / 'db_restore_to_point_in_time.json',
@@ -423,8 +551,6 @@ def test_point_in_time_create_snap_shot(mocker, monkeypatch, lambda_stub, rds_st
     target_db_instance_id = "tdi{0}".format(str(test_snapshot_id))
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
     _mock_describe_db_instances(rds_stub,  datafiles, target_db_instance_id, "Available")
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn) 
     create_db_response = {
         "DBSnapshot": {
             "DBSnapshotIdentifier": target_db_instance_id,
@@ -465,7 +591,7 @@ def test_point_in_time_create_snap_shot(mocker, monkeypatch, lambda_stub, rds_st
         "Tags": {
             "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
             "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            lambdas.ugc_rds_macro.point_in_time_db_instance_tag: '{0}:{1}:{2}'.format(target_db_instance_id, "creating", target_db_instance_id)
+            dv_instance_tag: '{0}:{1}:{2}'.format(target_db_instance_id, "creating", target_db_instance_id)
         }
     }
     lambda_stub.add_response(
@@ -477,14 +603,21 @@ def test_point_in_time_create_snap_shot(mocker, monkeypatch, lambda_stub, rds_st
     lambda_stub.add_response(
         "tag_resource",
         expected_params={
-            'Resource': test_context.invoked_function_arn, 'Tags': {lambdas.ugc_rds_macro.point_in_time_snapshot_db_instance_tag: "{0}:{1}:{2}".format(snapshot_id,"creating", target_db_instance_id)}},
+            'Resource': test_context.invoked_function_arn, 'Tags': {dv_snapshot_tag: "{0}:{1}:{2}".format(snapshot_id,"starting", target_db_instance_id)}},
         service_response={}
     )
 
     lambda_stub.add_response(
         "untag_resource",
         expected_params={'Resource': test_context.invoked_function_arn, 'TagKeys': [
-            'ugc:point-in-time:dbinstance']},
+            dv_instance_tag]},
+        service_response={}
+    )
+
+    lambda_stub.add_response(
+        "tag_resource",
+        expected_params={
+            'Resource': test_context.invoked_function_arn, 'Tags': {dv_snapshot_tag: "{0}:{1}:{2}".format(snapshot_id,"creating", target_db_instance_id)}},
         service_response={}
     )
 
@@ -524,12 +657,11 @@ def test_point_in_time_restore_to_a_specific_time(rds_stub, lambda_stub, monkeyp
 
     test_snapshot_id = uuid.uuid4()
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn)    
     _mock_list_tags(lambda_stub)
     _mock_describe_db_instances(rds_stub,  datafiles, None, None)
     target_db_instance_id = "tdi{0}".format(str(test_snapshot_id))
-    _mock_add_tag(lambda_stub, lambdas.ugc_rds_macro.point_in_time_db_instance_tag, target_db_instance_id)
+    _mock_add_tag(lambda_stub, dv_instance_tag, target_db_instance_id, "starting")
+    _mock_add_tag(lambda_stub, dv_instance_tag, target_db_instance_id)
 
     response = {
         "DBInstance": {
@@ -578,8 +710,6 @@ def test_point_in_time_restore_using_invalid_time(rds_stub, lambda_stub, monkeyp
 
     test_snapshot_id = uuid.uuid4()
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn)
     _mock_list_tags(lambda_stub)
     _mock_describe_db_instances(rds_stub,  datafiles, None, None)
 
@@ -620,11 +750,10 @@ def test_point_in_time_restore_latest_restorable_time(rds_stub, lambda_stub, clo
         monkeypatch.setattr(uuid, "uuid4", test_snapshot_id)
     """
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn)    
     _mock_list_tags(lambda_stub)
     _mock_describe_db_instances(rds_stub,  datafiles, None, None)
-    _mock_add_tag(lambda_stub, lambdas.ugc_rds_macro.point_in_time_db_instance_tag, target_db_instance_id)
+    _mock_add_tag(lambda_stub, dv_instance_tag, target_db_instance_id, "starting")
+    _mock_add_tag(lambda_stub, dv_instance_tag, target_db_instance_id)
 
     response = {
         "DBInstance": {
@@ -672,8 +801,6 @@ def test_point_in_time_restore_when_instance_is_being_created(rds_stub, lambda_s
     test_snapshot_id = uuid.uuid4()
     target_db_instance_id = "tdi{0}".format(str(test_snapshot_id))
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn)
     _mock_describe_db_instances(
         rds_stub,  datafiles, target_db_instance_id, "Creating")
 
@@ -681,7 +808,7 @@ def test_point_in_time_restore_when_instance_is_being_created(rds_stub, lambda_s
         "Tags": {
             "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
             "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            lambdas.ugc_rds_macro.point_in_time_db_instance_tag: target_db_instance_id
+            dv_instance_tag: target_db_instance_id
         }
     }
     lambda_stub.add_response(
@@ -724,8 +851,6 @@ def test_point_in_time_restore_when_instance_is_being_modified(rds_stub, lambda_
     test_snapshot_id = uuid.uuid4()
     target_db_instance_id = "tdi{0}".format(str(test_snapshot_id))
     mocker.patch.object(uuid, 'uuid4', return_value=test_snapshot_id)
-    _mock_get_function_name(lambda_stub, datafiles, test_context.function_name,
-                            test_context.invoked_function_arn)
     _mock_describe_db_instances(
         rds_stub,  datafiles, target_db_instance_id, "Modifying")
 
@@ -733,7 +858,7 @@ def test_point_in_time_restore_when_instance_is_being_modified(rds_stub, lambda_
         "Tags": {
             "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
             "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            lambdas.ugc_rds_macro.point_in_time_db_instance_tag: target_db_instance_id
+            dv_instance_tag: target_db_instance_id
         }
     }
     lambda_stub.add_response(
@@ -908,84 +1033,6 @@ def test_invalid_log_level(monkeypatch, datafiles):
     assert res['fragment'] == expected
 
 
-def test_remove_tag(lambda_stub):
-    lambda_stub.add_response(
-        "untag_resource",
-        expected_params={'Resource': test_context.invoked_function_arn, 'TagKeys': [
-            lambdas.ugc_rds_macro.point_in_time_db_instance_tag]},
-        service_response={}
-    )
-    remove_tag(lambdas.ugc_rds_macro.point_in_time_db_instance_tag, test_context.invoked_function_arn)
-
-
-def test_add_tag(lambda_stub):
-    tag = 'tag'
-    value = 'value'
-    lambda_stub.add_response(
-        "tag_resource",
-        expected_params={
-            'Resource': test_context.invoked_function_arn, 'Tags': {tag: value}},
-        service_response={}
-    )
-
-    add_tag(tag, value, test_context.invoked_function_arn)
-
-
-def test_get_tagged_point_in_time_restore(lambda_stub):
-    response = {
-        "Tags": {
-            "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
-            "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            "aws:cloudformation:stack-name": "ugc-rds-db-macro",
-            lambdas.ugc_rds_macro.point_in_time_db_instance_tag: "mr15xh2mg99mr07"
-        }
-    }
-    lambda_stub.add_response(
-        "list_tags",
-        expected_params={'Resource': test_context.invoked_function_arn},
-        service_response=response
-    )
-
-    point_in_time_id, snapshot_id = get_tagged_db_instance(test_context.invoked_function_arn)
-    assert point_in_time_id == "mr15xh2mg99mr07" and snapshot_id == None
-
-def test_get_tagged_point_in_time_snapshot_id(lambda_stub):
-    response = {
-        "Tags": {
-            "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
-            "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            "aws:cloudformation:stack-name": "ugc-rds-db-macro",
-            lambdas.ugc_rds_macro.point_in_time_snapshot_db_instance_tag : "snapshot_id"
-        }
-    }
-    lambda_stub.add_response(
-        "list_tags",
-        expected_params={'Resource': test_context.invoked_function_arn},
-        service_response=response
-    )
-
-    point_in_time_id, snapshot_id = get_tagged_db_instance(test_context.invoked_function_arn)
-    assert snapshot_id == "snapshot_id" and point_in_time_id == None
-
-
-def test_get_tagged_db_instance_when_no_instance(lambda_stub):
-    response = {
-        "Tags": {
-            "aws:cloudformation:logical-id": "RdsSnapShotLambdaFunction",
-            "aws:cloudformation:stack-id": "arn:aws:cloudformation:eu-west-2:546933502184:stack/ugc-rds-db-macro/ef020480-19c5-11ea-9f4f-0617023ccf6e",
-            "aws:cloudformation:stack-name": "ugc-rds-db-macro"
-        }
-    }
-    lambda_stub.add_response(
-        "list_tags",
-        expected_params={'Resource': test_context.invoked_function_arn},
-        service_response=response
-    )
-
-    point_in_time_instance_id, snap_shot_id = get_tagged_db_instance(test_context.invoked_function_arn)
-    assert point_in_time_instance_id == None and snap_shot_id == None
-
-
 def test_when_stack_name_is_not_supplied(monkeypatch, datafiles):
 
     monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", test_context.function_name)
@@ -1073,4 +1120,1045 @@ def test_get_snapshot_state_when_instance_does_not_exist(rds_stub):
         service_error_code='DBSnapshotNotFound',
         service_message=msg)
     status = get_snapshot_state(snapshot_id)
-    assert status == None
\ No newline at end of file
+    assert status == None
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_describe_instance_response.json'
+)
+def test_rds_inventory_follows_pagination(rds_stub, datafiles):
+    for testFile in datafiles.listdir():
+        if fnmatch.fnmatch(testFile, "*db_describe_instance_response.json"):
+            response = json.loads(testFile.read_text(encoding="utf-8"))
+
+    instances = response['DBInstances']
+    rds_stub.add_response(
+        'describe_db_instances',
+        expected_params={},
+        service_response={'DBInstances': instances[:2], 'Marker': 'page-2'}
+    )
+    rds_stub.add_response(
+        'describe_db_instances',
+        expected_params={'Marker': 'page-2'},
+        service_response={'DBInstances': instances[2:]}
+    )
+
+    inventory = RdsInventory()
+    assert not inventory.loaded
+    assert len(inventory) == len(instances)
+    assert inventory.by_identifier('mr1qf4ez7ls7xfn')['BackupRetentionPeriod'] == 30
+    assert inventory.resolver().resolve('test-ugc-rds-stack') == 'test-ugc-postgres'
+    assert len(inventory.by_status('Available')) == len(instances)
+
+    # second phase of the same invocation reuses the listing
+    assert get_instance_state('dv-ugc-postgres', inventory) == 'available'
+    assert get_back_retention_period(inventory, 'dv-ugc-postgres') == 100
+
+
+def test_parse_db_identifier_prefers_closest_subnet_group_regardless_of_order():
+    instances = [
+        {'DBInstanceIdentifier': 'longer', 'DBSubnetGroup': {
+            'DBSubnetGroupName': 'dv-rds-database-stack-subnetgroup-17xc8x9i77y7q'}},
+        {'DBInstanceIdentifier': 'wanted', 'DBSubnetGroup': {
+            'DBSubnetGroupName': 'dv-rds-subnetgroup-1w5dcjlw3wwpi'}},
+        {'DBInstanceIdentifier': 'no-boundary', 'DBSubnetGroup': {
+            'DBSubnetGroupName': 'dv-rdsx-subnetgroup'}},
+        {'DBInstanceIdentifier': 'no-subnet-group'},
+    ]
+
+    assert parse_db_identifier({'DBInstances': instances}, 'dv-rds') == 'wanted'
+    assert parse_db_identifier(
+        {'DBInstances': list(reversed(instances))}, 'dv-rds') == 'wanted'
+    assert parse_db_identifier({'DBInstances': instances}, 'dv-rds-database') == 'longer'
+    assert parse_db_identifier({'DBInstances': instances}, 'mv-rds') == None
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_describe_single_instance.json'
+)
+def test_find_stack_db_instance_using_stack_resource(rds_stub, cloudformation_stub, monkeypatch, datafiles):
+    monkeypatch.setenv("resolve_from_stack_resources", "true")
+    for testFile in datafiles.listdir():
+        if fnmatch.fnmatch(testFile, "*db_describe_single_instance.json"):
+            response = json.loads(testFile.read_text(encoding="utf-8"))
+
+    cloudformation_stub.add_response(
+        'describe_stack_resource',
+        expected_params={'StackName': 'wingse-rds-db-stack',
+                         'LogicalResourceId': 'UGCDatabase'},
+        service_response={'StackResourceDetail': {
+            'LogicalResourceId': 'UGCDatabase',
+            'PhysicalResourceId': 'wingse',
+            'ResourceType': 'AWS::RDS::DBInstance',
+            'LastUpdatedTimestamp': datetime(2019, 12, 6, 11, 10, 33),
+            'ResourceStatus': 'UPDATE_COMPLETE'}}
+    )
+    rds_stub.add_response(
+        'describe_db_instances',
+        expected_params={'DBInstanceIdentifier': 'wingse'},
+        service_response=response
+    )
+
+    inventory = RdsInventory()
+    assert find_stack_db_instance('wingse-rds-db-stack', inventory) == 'wingse'
+    assert get_instance_state('wingse', inventory) == 'available'
+    assert not inventory.loaded
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_describe_instance_response.json'
+)
+def test_find_stack_db_instance_falls_back_to_subnet_group(rds_stub, cloudformation_stub, monkeypatch, datafiles):
+    monkeypatch.setenv("resolve_from_stack_resources", "true")
+    cloudformation_stub.add_client_error(
+        'describe_stack_resource',
+        expected_params={'StackName': 'mv-rds-db-stack',
+                         'LogicalResourceId': 'UGCDatabase'},
+        service_error_code='ValidationError',
+        service_message='Stack mv-rds-db-stack does not exist')
+    _mock_describe_db_instances(rds_stub, datafiles, None, None)
+
+    assert find_stack_db_instance('mv-rds-db-stack', RdsInventory()) == 'mr1qf4ez7ls7xfn'
+
+
+def test_select_latest_snapshot_streams_every_page(rds_stub):
+    def snapshot(name, created, status='available'):
+        return {'DBSnapshotIdentifier': name,
+                'DBSnapshotArn': 'arn:aws:rds:eu-west-2:546933502184:snapshot:' + name,
+                'SnapshotCreateTime': created,
+                'Status': status,
+                'SnapshotType': 'manual'}
+
+    rds_stub.add_response(
+        'describe_db_snapshots',
+        expected_params={'DBInstanceIdentifier': 'mr1qf4ez7ls7xfn',
+                         'SnapshotType': 'manual'},
+        service_response={'DBSnapshots': [
+            snapshot('old', datetime(2019, 12, 1, tzinfo=timezone.utc)),
+            snapshot('older', datetime(2019, 11, 1, tzinfo=timezone.utc))],
+            'Marker': 'page-2'}
+    )
+    rds_stub.add_response(
+        'describe_db_snapshots',
+        expected_params={'DBInstanceIdentifier': 'mr1qf4ez7ls7xfn',
+                         'SnapshotType': 'manual', 'Marker': 'page-2'},
+        service_response={'DBSnapshots': [
+            snapshot('newest', datetime(2019, 12, 6, tzinfo=timezone.utc)),
+            snapshot('creating', datetime(2019, 12, 7, tzinfo=timezone.utc), 'creating')]}
+    )
+
+    latest = select_latest_snapshot(iter_db_snapshots('mr1qf4ez7ls7xfn', 'manual'))
+    assert latest['DBSnapshotIdentifier'] == 'newest'
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used():
+    now = [0]
+    cache = TTLCache(2, 10, clock=lambda: now[0])
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') == None
+    now[0] = 11
+    assert cache.get('a') == None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1}
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_instance_template.json',
+)
+def test_get_ugc_database_template_is_cached_until_stack_changes(monkeypatch, mocker, cloudformation_stub, datafiles):
+    for testFile in datafiles.listdir():
+        if fnmatch.fnmatch(testFile, "*db_instance_template.json"):
+            db_instance_template = json.loads(testFile.read_text(encoding="utf-8"))
+
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'do_not_ignore_get_template', True)
+    invalidate_deployed_template()
+    get_template = mocker.patch.object(
+        lambdas.ugc_rds_macro.cf_client, 'get_template',
+        return_value={'TemplateBody': {'Resources': {'UGCDatabase': db_instance_template}}})
+
+    def describe_stacks(last_updated):
+        cloudformation_stub.add_response(
+            'describe_stacks',
+            expected_params={'StackName': 'dv-rds-database-stack'},
+            service_response={'Stacks': [{
+                'StackName': 'dv-rds-database-stack',
+                'CreationTime': datetime(2019, 12, 1),
+                'LastUpdatedTime': last_updated,
+                'StackStatus': 'UPDATE_COMPLETE'}]})
+
+    describe_stacks(datetime(2019, 12, 6))
+    describe_stacks(datetime(2019, 12, 6))
+    describe_stacks(datetime(2019, 12, 7))
+
+    first = get_ugc_database_template('dv-rds-database-stack')
+    assert get_ugc_database_template('dv-rds-database-stack') is first
+    assert get_template.call_count == 1
+
+    get_ugc_database_template('dv-rds-database-stack')
+    assert get_template.call_count == 2
+    assert first == db_instance_template
+    invalidate_deployed_template('dv-rds-database-stack')
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / 'db_instance_template.json',
+    FIXTURE_DIR / 'db_instance_template_with_snapshot_specified.json',
+)
+def test_handler_falls_back_to_a_copy_of_the_deployed_template(monkeypatch, mocker, datafiles):
+    (deployed, db_instance_template) = _read_test_data(datafiles,
+                                                       "db_instance_template_with_snapshot_specified.json",
+                                                       "db_instance_template.json")
+    monkeypatch.setenv("properties_to_remove", "")
+    monkeypatch.setenv("replace_with_snapshot", "false")
+    monkeypatch.setenv("snapshot_id", "")
+    monkeypatch.setenv("properties_to_add", "")
+    monkeypatch.setenv("rds_snapshot_stack_name", "")
+    monkeypatch.setenv("restore_time", "")
+    monkeypatch.setenv("restore_point_in_time", "")
+    mocker.patch.object(lambdas.ugc_rds_macro, 'get_deployed_resources',
+                        return_value={'UGCDatabase': deployed})
+    mocker.patch.object(lambdas.ugc_rds_macro, 'apply_fragment_ops',
+                        side_effect=KeyError('Properties'))
+
+    i = {'stackname': 'one-rds-db-stack'}
+    f = {'fragment': db_instance_template,
+         'requestId': 'my_request_id', 'params': i}
+
+    res = handler(f, test_context)
+    assert res['fragment'] == deployed
+    assert res['fragment'] is not deployed
+
+
+def test_handler_falls_back_when_the_restore_state_store_is_unreachable(monkeypatch, mocker, tmpdir):
+    deployed = {'Properties': {'DBName': 'db', 'DBSnapshotIdentifier': 'rsi1'}}
+    monkeypatch.setenv("restore_point_in_time", "true")
+    monkeypatch.setenv("restore_state_store", "sqlite")
+    # A directory, which sqlite can not open.
+    monkeypatch.setenv("restore_state_path", str(tmpdir))
+    mocker.patch.object(lambdas.ugc_rds_macro, 'get_deployed_resources',
+                        return_value={'UGCDatabase': deployed})
+
+    f = {'fragment': {'Properties': {'DBName': 'db'}},
+         'requestId': 'my_request_id', 'params': {'stackname': 'one-rds-db-stack'}}
+    assert handler(f, test_context)['fragment'] == deployed
+
+    config = MacroConfig.from_environ({
+        'replace_with_snapshot': 'true', 'restore_state_store': 'sqlite',
+        'restore_state_path': str(tmpdir), 'idempotency_window_seconds': '300'})
+    assert get_idempotent_request('one-rds-db-stack', {}, config, test_context) is None
+
+
+def test_restore_in_progress_does_not_list_the_account(monkeypatch, mocker):
+    class ListingAccount(FakeRestoreAccount):
+        listed = []
+
+        def get_paginator(self, name):
+            self.listed.append(name)
+            return FakeRestoreAccount.get_paginator(self, name)
+
+    stack = 'dv-rds-database-stack'
+    account = ListingAccount([stack])
+    account.instances['tdi1'] = {'DBInstanceIdentifier': 'tdi1', 'DBInstanceStatus': 'creating'}
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    mocker.patch.object(lambdas.ugc_rds_macro, 'get_deployed_resources',
+                        return_value={'UGCDatabase': {'Properties': {'DBName': 'db'}}})
+    monkeypatch.setenv("restore_point_in_time", "true")
+    store = get_restore_state_store(test_context.invoked_function_arn, get_config(), stack)
+    store.compare_and_set(RestoreState.idle(), RestoreState('restoring', 'tdi1', None, 'creating', ()))
+
+    f = {'fragment': {'Properties': {'DBName': 'db'}},
+         'requestId': 'my_request_id', 'params': {'stackname': stack}}
+    handler(f, test_context)
+    handler(f, test_context)
+
+    assert store.get().phase == 'snapshotting'
+    assert account.listed == []
+
+
+def test_log_payload_is_truncated_and_only_serialised_when_emitted(caplog):
+    class Counted(object):
+        calls = 0
+
+        def __str__(self):
+            Counted.calls += 1
+            return 'counted'
+
+    payload = _payload({'Tags': ['x' * 100] * 1000})
+    text = str(payload)
+    assert len(text) <= lambdas.ugc_rds_macro.log_payload_max_chars + len("...<truncated>")
+    assert text.endswith("...<truncated>")
+
+    caplog.set_level(logging.INFO, logger='lambdas.ugc_rds_macro')
+    lambdas.ugc_rds_macro.logger.bind(requestId='my_request_id', stackname='dv-rds-database-stack')
+    lambdas.ugc_rds_macro.logger.debug("%s", _payload(Counted()))
+    lambdas.ugc_rds_macro.logger.info("fragment=%s", _payload({'a': 1}))
+    lambdas.ugc_rds_macro.logger.clear()
+
+    assert Counted.calls == 0
+    assert caplog.messages == [
+        '[requestId=my_request_id stackname=dv-rds-database-stack] '
+        ':test_log_payload_is_truncated_and_only_serialised_when_emitted:fragment={"a": 1}']
+    assert caplog.records[0].requestId == 'my_request_id'
+
+
+def test_clients_are_created_once_on_first_use():
+    provider = ClientProvider()
+    assert provider.created() == []
+
+    cloudformation = provider.get('cloudformation')
+    assert provider.get('cloudformation') is cloudformation
+    assert provider.created() == ['cloudformation']
+
+    assert lambdas.ugc_rds_macro.client is lambdas.ugc_rds_macro.clients.get('rds')
+    with pytest.raises(AttributeError):
+        lambdas.ugc_rds_macro.not_a_client
+
+
+def test_clients_share_one_tuned_config(monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'eu-west-1')
+    rds = ClientProvider().get('rds')
+    config = rds.meta.config
+
+    assert rds.meta.region_name == 'eu-west-1'
+    assert rds.meta.endpoint_url == 'https://rds.eu-west-1.amazonaws.com'
+    assert config.max_pool_connections >= lambdas.ugc_rds_macro.prefetch_max_workers + 1
+    assert config.connect_timeout == lambdas.ugc_rds_macro.client_connect_timeout_seconds
+    assert config.read_timeout == lambdas.ugc_rds_macro.client_read_timeout_seconds
+    assert config.tcp_keepalive is True
+    assert config.retries == {'mode': 'adaptive',
+                              'total_max_attempts': lambdas.ugc_rds_macro.api_max_attempts}
+
+
+def test_client_config_falls_back_on_botocore_without_retry_modes(monkeypatch):
+    import botocore.config
+    from botocore.exceptions import InvalidRetryConfigurationError
+
+    class OldConfig(object):
+        # botocore 1.12: neither tcp_keepalive nor retry modes.
+        def __init__(self, retries=None, **kwargs):
+            if 'tcp_keepalive' in kwargs:
+                raise TypeError('tcp_keepalive')
+            if set(retries) - set(['max_attempts']):
+                raise InvalidRetryConfigurationError(
+                    retry_config_option=sorted(retries)[0],
+                    valid_options='max_attempts')
+            self.retries = retries
+
+    monkeypatch.setattr(botocore.config, 'Config', OldConfig)
+    config = lambdas.ugc_rds_macro.client_config()
+    assert config.retries == {'max_attempts': lambdas.ugc_rds_macro.api_max_attempts - 1}
+
+
+class ThrottlingEndpoint(object):
+    # Stands in for the rds endpoint, answering the first throttle_first
+    # requests with a Throttling error. Hooked in before the request is sent,
+    # so botocore retries it like any other response.
+    throttled = (b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+                 b'<Message>Rate exceeded</Message></Error><RequestId>1</RequestId></ErrorResponse>')
+    ok = (b'<DescribeDBInstancesResponse><DescribeDBInstancesResult><DBInstances/>'
+          b'</DescribeDBInstancesResult><ResponseMetadata><RequestId>2</RequestId>'
+          b'</ResponseMetadata></DescribeDBInstancesResponse>')
+
+    def __init__(self, throttle_first):
+        self.throttle_first = throttle_first
+        self.requests = 0
+
+    def __call__(self, request, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        self.requests += 1
+        if self.requests <= self.throttle_first:
+            return AWSResponse(request.url, 400, {}, _RawBody(self.throttled))
+        return AWSResponse(request.url, 200, {}, _RawBody(self.ok))
+
+
+class _RawBody(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+@pytest.mark.parametrize('throttle_first,raises', [(2, False), (9, True)])
+def test_throttled_calls_are_retried_and_counted(monkeypatch, throttle_first, raises):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    # The adaptive rate limiter waits on the wall clock; the retries and
+    # counts are the same in standard mode.
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'api_retry_mode', 'standard')
+    backoffs = []
+    monkeypatch.setattr(time, 'sleep', backoffs.append)
+    limiter = ApiCallLimiter()
+    rds = ClientProvider(limiter).get('rds')
+    endpoint = ThrottlingEndpoint(throttle_first)
+    rds.meta.events.register('before-send', endpoint)
+
+    if raises:
+        with pytest.raises(Exception) as e:
+            rds.describe_db_instances()
+        assert e.value.response['Error']['Code'] == 'Throttling'
+    else:
+        rds.describe_db_instances()
+
+    attempts = min(throttle_first + 1, lambdas.ugc_rds_macro.api_max_attempts)
+    assert endpoint.requests == attempts
+    assert len(backoffs) == attempts - 1
+    counts = limiter.counts()['rds.read']
+    assert counts['calls'] == 1
+    assert counts['throttles'] == min(throttle_first, attempts)
+    assert counts['retries'] == attempts - 1
+
+
+def test_token_bucket_paces_after_the_burst_and_adapts_to_throttling():
+    now = [0.0]
+    slept = []
+    bucket = TokenBucket(2, 2, clock=lambda: now[0], sleep=slept.append)
+
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    bucket.throttled()
+    assert bucket.rate == 1
+    now[0] += 10
+    assert bucket.acquire() == 0
+    bucket.succeeded()
+    assert bucket.rate == 1.2
+    assert slept == [0.5, 1.0]
+
+
+def test_macro_config_keeps_commas_inside_property_values():
+    config = MacroConfig.from_environ({
+        'log_level': 'debug',
+        'replace_with_snapshot': 'True',
+        'snapshot_type': 'Manual',
+        'properties_to_add': '{"Tags": [{"Key": "a", "Value": "b"}]}, {"DBName": "x,y"}',
+        'properties_to_remove': 'BackupRetentionPeriod, DBName',
+    })
+
+    assert config.log_level == logging.DEBUG
+    assert config.replace_with_snapshot == True
+    assert config.restore_point_in_time == False
+    assert config.snapshot_type == 'manual'
+    assert config.properties_to_add == (
+        ('Tags', [{'Key': 'a', 'Value': 'b'}]), ('DBName', 'x,y'))
+    assert config.properties_to_remove == ('BackupRetentionPeriod', 'DBName')
+    assert MacroConfig.from_environ(
+        {'properties_to_add': '[{"DBName": "x,y"}]'}).properties_to_add == (('DBName', 'x,y'),)
+
+
+def test_fragment_ops_are_compiled_once_and_reach_nested_properties():
+    config = MacroConfig.from_environ({
+        'replace_with_snapshot': 'true',
+        'properties_to_add': '{"MonitoringConfig.Interval": 60}, {"Tags.0.Value": "c"}',
+        'properties_to_remove': 'BackupRetentionPeriod, Storage.Iops, Tags.1',
+    })
+    ops = get_fragment_ops(config)
+    assert get_fragment_ops(config) is ops
+    assert [op.stage for op in ops] == ['snapshot'] * 3 + ['remove'] * 3 + ['add'] * 2
+
+    fragment = {'Type': 'AWS::RDS::DBInstance', 'Properties': {
+        'DBName': 'ugc', 'DBInstanceIdentifier': 'one-ugc-postgres',
+        'BackupRetentionPeriod': 7, 'Storage': {'Iops': 1000, 'Type': 'io1'},
+        'Tags': [{'Key': 'a', 'Value': 'b'}, {'Key': 'd', 'Value': 'e'}]}}
+    apply_fragment_ops(fragment, ops, 'snap-1')
+
+    assert fragment['Properties'] == {
+        'DBSnapshotIdentifier': 'snap-1', 'Storage': {'Type': 'io1'},
+        'Tags': [{'Key': 'a', 'Value': 'c'}], 'MonitoringConfig': {'Interval': 60}}
+    # Without a snapshot to restore from only the identifiers are removed.
+    fragment = {'Properties': {'DBName': 'ugc'}}
+    apply_fragment_ops(fragment, get_fragment_ops(config, 'snapshot'))
+    assert fragment == {'Properties': {}}
+
+
+@pytest.mark.parametrize("name,value", [
+    ('log_level', 'not_valid'),
+    ('snapshot_type', 'invalid_snapshot_type'),
+    ('replace_with_snapshot', 'yes'),
+    ('properties_to_add', '{"DBName": '),
+    ('properties_to_add', '["DBName"]'),
+    ('restore_in_background', 'true'),
+])
+def test_macro_config_rejects_invalid_values(name, value):
+    with pytest.raises(MacroConfigError):
+        MacroConfig.from_environ({name: value})
+
+
+def test_get_config_is_parsed_once_per_environment(monkeypatch):
+    monkeypatch.setenv("properties_to_add", '{"DBName": "x"}')
+    config = get_config()
+    assert get_config() is config
+
+    monkeypatch.setenv("properties_to_add", '{"DBName": "y"}')
+    assert get_config().properties_to_add == (('DBName', 'y'),)
+
+
+def test_invoked_function_arn_comes_from_the_context():
+    class AliasContext:
+        invoked_function_arn = test_context.invoked_function_arn + ":live"
+
+        def get_remaining_time_in_millis(self):
+            return 1234
+
+    assert get_invoked_function_arn(test_context) == test_context.invoked_function_arn
+    assert get_invoked_function_arn(AliasContext()) == test_context.invoked_function_arn
+    assert get_remaining_time_millis(AliasContext()) == 1234
+    assert get_remaining_time_millis(test_context) == None
+
+
+def test_restore_state_is_read_once_and_written_in_one_batch(lambda_stub):
+    instance_tag = lambdas.ugc_rds_macro.point_in_time_db_instance_tag
+    snapshot_tag = lambdas.ugc_rds_macro.point_in_time_snapshot_db_instance_tag
+    lambda_stub.add_response(
+        "list_tags",
+        expected_params={'Resource': test_context.invoked_function_arn},
+        service_response={"Tags": {
+            "ugc:point-in-time:dbinstance:old": "ignored",
+            instance_tag: "tdi1:available"}}
+    )
+    lambda_stub.add_response(
+        "tag_resource",
+        expected_params={'Resource': test_context.invoked_function_arn,
+                         'Tags': {snapshot_tag: "rsi1:creating:tdi1"}},
+        service_response={}
+    )
+    lambda_stub.add_response(
+        "untag_resource",
+        expected_params={'Resource': test_context.invoked_function_arn,
+                         'TagKeys': [instance_tag]},
+        service_response={}
+    )
+
+    state = read_restore_state(test_context.invoked_function_arn)
+    assert state == RestoreState('restoring', 'tdi1', None, 'available', (instance_tag,))
+
+    state = write_restore_state(test_context.invoked_function_arn, state, RestoreState(
+        'snapshotting', 'tdi1', 'rsi1', 'creating', ()))
+    assert state.tag_keys == (snapshot_tag,)
+    assert RestoreState.from_tags(state.to_tags()) == state
+
+
+def test_sqlite_state_store_only_applies_expected_transitions(tmpdir):
+    store = SqliteStateStore(str(tmpdir.join('state.db')), test_context.invoked_function_arn)
+    idle = store.get()
+    restoring = RestoreState('restoring', 'tdi1', None, 'creating', ())
+    snapshotting = RestoreState('snapshotting', 'tdi1', 'rsi1', 'creating', ())
+
+    assert idle == RestoreState.idle()
+    assert store.compare_and_set(idle, restoring) == restoring
+    with pytest.raises(RestoreStateConflict):
+        store.compare_and_set(idle, restoring)
+    store.compare_and_set(restoring, snapshotting)
+    with pytest.raises(RestoreStateConflict):
+        store.compare_and_set(restoring, RestoreState.idle())
+    assert store.get() == snapshotting
+    store.compare_and_set(snapshotting, RestoreState.idle())
+    assert store.get() == RestoreState.idle()
+
+
+def test_dynamodb_state_store_uses_one_conditional_write():
+    dynamodb = lambdas.ugc_rds_macro.clients.session().client('dynamodb')
+    store = DynamoDbStateStore('restore-state', 'arn', dynamodb)
+    restoring = RestoreState('restoring', 'tdi1', None, 'creating', ())
+    with Stubber(dynamodb) as stubber:
+        stubber.add_response(
+            "put_item",
+            expected_params={
+                'TableName': 'restore-state',
+                'Item': {'id': {'S': 'arn'},
+                         'state': {'S': lambdas.ugc_rds_macro._encode_restore_state(restoring)}},
+                'ConditionExpression': 'attribute_not_exists(id)'},
+            service_response={})
+        stubber.add_client_error(
+            "delete_item", service_error_code='ConditionalCheckFailedException')
+
+        stubber.add_response(
+            "get_item",
+            expected_params={'TableName': 'restore-state', 'Key': {'id': {'S': 'arn'}},
+                             'ConsistentRead': True},
+            service_response={'Item': {
+                'id': {'S': 'arn'},
+                'state': {'S': lambdas.ugc_rds_macro._encode_restore_state(restoring)}}})
+
+        assert store.compare_and_set(RestoreState.idle(), restoring) == restoring
+        with pytest.raises(RestoreStateConflict):
+            store.compare_and_set(restoring, RestoreState.idle())
+        with pytest.raises(RestoreStateConflict):
+            store.compare_and_set(RestoreState.idle(), RestoreState.idle())
+        stubber.assert_no_pending_responses()
+
+
+def test_restore_state_store_comes_from_config(monkeypatch):
+    arn = test_context.invoked_function_arn
+    assert isinstance(get_restore_state_store(arn), LambdaTagStateStore)
+
+    monkeypatch.setenv("restore_state_store", "dynamodb")
+    with pytest.raises(MacroConfigError):
+        MacroConfig.from_environ()
+
+    monkeypatch.setenv("restore_state_table", "restore-state")
+    store = get_restore_state_store(arn, MacroConfig.from_environ())
+    assert isinstance(store, DynamoDbStateStore) and store.table_name == "restore-state"
+
+
+class FakeRestoreAccount(object):
+    # Just enough of rds and the lambda tags for point in time restores to
+    # run end to end. Each describe moves a resource one step further on.
+
+    def __init__(self, stacks):
+        self.lock = threading.Lock()
+        self.tags = {}
+        self.instances = {}
+        self.snapshots = {}
+        self.deleted = []
+        self.invocations = []
+        for stack in stacks:
+            self.instances["{0}-ugc-postgres".format(stack)] = {
+                'DBInstanceIdentifier': "{0}-ugc-postgres".format(stack),
+                'DBInstanceStatus': 'available',
+                'BackupRetentionPeriod': 7,
+                'DBSubnetGroup': {'DBSubnetGroupName': "{0}-subnetgroup-x1".format(stack)},
+            }
+
+    def list_tags(self, Resource):
+        with self.lock:
+            return {'Tags': dict(self.tags)}
+
+    def tag_resource(self, Resource, Tags):
+        with self.lock:
+            self.tags.update(Tags)
+        return {}
+
+    def untag_resource(self, Resource, TagKeys):
+        with self.lock:
+            for key in TagKeys:
+                del self.tags[key]
+        return {}
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        with self.lock:
+            self.invocations.append(json.loads(Payload.decode('utf-8')))
+        return {'StatusCode': 202}
+
+    def describe_db_instances(self, DBInstanceIdentifier):
+        with self.lock:
+            if DBInstanceIdentifier not in self.instances:
+                raise ClientError({'Error': {'Code': 'DBInstanceNotFound'}},
+                                  'DescribeDBInstances')
+            instance = self.instances[DBInstanceIdentifier]
+            page = dict(instance)
+            instance['DBInstanceStatus'] = 'available'
+            return {'DBInstances': [page]}
+
+    def get_paginator(self, name):
+        account = self
+
+        class Paginator(object):
+            def paginate(self):
+                with account.lock:
+                    page = [dict(i) for i in account.instances.values()]
+                    for instance in account.instances.values():
+                        instance['DBInstanceStatus'] = 'available'
+                    return [{'DBInstances': page}]
+        return Paginator()
+
+    def restore_db_instance_to_point_in_time(self, SourceDBInstanceIdentifier,
+                                             TargetDBInstanceIdentifier, **kwargs):
+        with self.lock:
+            instance = dict(self.instances[SourceDBInstanceIdentifier],
+                            DBInstanceIdentifier=TargetDBInstanceIdentifier,
+                            DBInstanceStatus='creating',
+                            SourceDBInstanceIdentifier=SourceDBInstanceIdentifier,
+                            DBSubnetGroup={'DBSubnetGroupName': 'restored'})
+            self.instances[TargetDBInstanceIdentifier] = instance
+        return {'DBInstance': dict(instance)}
+
+    def create_db_snapshot(self, DBSnapshotIdentifier, DBInstanceIdentifier):
+        with self.lock:
+            self.snapshots[DBSnapshotIdentifier] = {
+                'DBSnapshotIdentifier': DBSnapshotIdentifier, 'Status': 'creating',
+                'DBInstanceIdentifier': DBInstanceIdentifier}
+            return {'DBSnapshot': dict(self.snapshots[DBSnapshotIdentifier])}
+
+    def describe_db_snapshots(self, DBSnapshotIdentifier):
+        with self.lock:
+            if DBSnapshotIdentifier not in self.snapshots:
+                raise ClientError({'Error': {'Code': 'DBSnapshotNotFound'}},
+                                  'DescribeDBSnapshots')
+            snapshot = self.snapshots[DBSnapshotIdentifier]
+            status = snapshot['Status']
+            snapshot['Status'] = 'available'
+            return {'DBSnapshots': [dict(snapshot, Status=status)]}
+
+    def delete_db_instance(self, DBInstanceIdentifier, SkipFinalSnapshot):
+        with self.lock:
+            self.deleted.append(self.instances.pop(DBInstanceIdentifier))
+        return {'DBInstance': {'DBInstanceIdentifier': DBInstanceIdentifier}}
+
+    def restored_from(self, snapshot_id):
+        with self.lock:
+            instance_id = self.snapshots[snapshot_id]['DBInstanceIdentifier']
+            for instance in self.deleted:
+                if instance['DBInstanceIdentifier'] == instance_id:
+                    return instance['SourceDBInstanceIdentifier']
+
+
+def test_point_in_time_restores_of_many_stacks_progress_independently(monkeypatch):
+    stacks = ["stack{0:02d}-rds-db".format(i) for i in range(40)]
+    account = FakeRestoreAccount(stacks)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    config = MacroConfig.from_environ({'restore_point_in_time': 'true'})
+
+    def restore(stack):
+        for _ in range(10):
+            fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+            point_in_time_restore(fragment, stack, None,
+                                  RdsInventory(rds_client=account), config, test_context)
+            if 'DBSnapshotIdentifier' in fragment['Properties']:
+                return fragment['Properties']['DBSnapshotIdentifier']
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        snapshots = dict(zip(stacks, pool.map(restore, stacks)))
+
+    for stack, snapshot_id in snapshots.items():
+        assert snapshot_id is not None
+        assert account.restored_from(snapshot_id) == "{0}-ugc-postgres".format(stack)
+    assert account.tags == {}
+    assert len(account.deleted) == len(stacks)
+
+
+def test_restored_snapshot_is_applied_when_deleting_the_instance_fails(monkeypatch):
+    class FailingDeleteAccount(FakeRestoreAccount):
+        def delete_db_instance(self, DBInstanceIdentifier, SkipFinalSnapshot):
+            raise ClientError({'Error': {'Code': 'InvalidDBInstanceState'}},
+                              'DeleteDBInstance')
+
+    stack = 'dv-rds-database-stack'
+    account = FailingDeleteAccount([stack])
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    config = MacroConfig.from_environ({'restore_point_in_time': 'true'})
+
+    for _ in range(10):
+        fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+        point_in_time_restore(fragment, stack, None,
+                              RdsInventory(rds_client=account), config, test_context)
+        if 'DBSnapshotIdentifier' in fragment['Properties']:
+            break
+
+    # The restored instance is left behind, its snapshot still applied.
+    snapshot_id = fragment['Properties']['DBSnapshotIdentifier']
+    restored = account.instances[account.snapshots[snapshot_id]['DBInstanceIdentifier']]
+    assert restored['SourceDBInstanceIdentifier'] == "{0}-ugc-postgres".format(stack)
+    assert account.tags == {}
+
+
+def test_concurrent_invocations_restore_one_instance_and_snapshot(monkeypatch, tmpdir):
+    # Both invocations read the same state before either moves it on.
+    barrier = threading.Barrier(2, timeout=5)
+
+    class RacingStore(SqliteStateStore):
+        def get(self):
+            state = super(RacingStore, self).get()
+            barrier.wait()
+            return state
+
+    stack = 'dv-rds-database-stack'
+    account = FakeRestoreAccount([stack])
+    store = RacingStore(str(tmpdir.join('state.db')), stack)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'get_restore_state_store',
+                        lambda *args: store)
+    config = MacroConfig.from_environ({'restore_point_in_time': 'true'})
+
+    def stack_update(_):
+        fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+        point_in_time_restore(fragment, stack, None,
+                              RdsInventory(rds_client=account), config, test_context)
+        return fragment['Properties'].get('DBSnapshotIdentifier')
+
+    applied = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for _ in range(10):
+            applied = [s for s in pool.map(stack_update, range(2)) if s]
+            if applied:
+                break
+
+    restored = [i for i in list(account.instances.values()) + account.deleted
+                if 'SourceDBInstanceIdentifier' in i]
+    assert len(restored) == 1 and len(account.snapshots) == 1
+    assert applied == list(account.snapshots)
+    assert account.deleted == restored
+    assert SqliteStateStore.get(store) == RestoreState.idle()
+
+
+@pytest.mark.parametrize('phase,status', [
+    ('restoring', 'incompatible-restore'), ('restoring', None),
+    ('snapshotting', 'failed'), ('snapshotting', None)])
+def test_failed_or_missing_restore_resources_end_the_restore(monkeypatch, phase, status):
+    stack = 'dv-rds-database-stack'
+    account = FakeRestoreAccount([stack])
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    config = MacroConfig.from_environ({'restore_point_in_time': 'true'})
+    store = get_restore_state_store(test_context.invoked_function_arn, config, stack)
+
+    def stack_update():
+        fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+        point_in_time_restore(fragment, stack, None,
+                              RdsInventory(rds_client=account), config, test_context)
+        return fragment
+
+    for _ in range(10):
+        stack_update()
+        if store.get().phase == phase:
+            break
+    restore_state = store.get()
+    if phase == 'restoring':
+        resources, resource_id = account.instances, restore_state.instance_id
+    else:
+        resources, resource_id = account.snapshots, restore_state.snapshot_id
+    if status is None:
+        del resources[resource_id]
+    else:
+        resources[resource_id]['DBInstanceStatus' if phase == 'restoring' else 'Status'] = status
+
+    assert 'DBSnapshotIdentifier' not in stack_update()['Properties']
+    assert store.get() == RestoreState.idle() and account.tags == {}
+    deleted = [i['DBInstanceIdentifier'] for i in account.deleted]
+    assert deleted == ([] if phase == 'restoring' and status is None
+                       else [restore_state.instance_id])
+
+    # The next stack update starts over.
+    stack_update()
+    assert store.get().phase == 'restoring'
+    assert store.get().instance_id != restore_state.instance_id
+
+
+def test_background_restore_stops_handing_over_after_the_limit(monkeypatch, tmpdir):
+    stack = 'dv-rds-database-stack'
+    account = FakeRestoreAccount([stack])
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    config = MacroConfig.from_environ({
+        'restore_point_in_time': 'true', 'restore_in_background': 'true',
+        'restore_state_store': 'sqlite', 'restore_state_path': str(tmpdir.join('state.db'))})
+    store = get_restore_state_store(test_context.invoked_function_arn, config, stack)
+    restoring = store.compare_and_set(RestoreState.idle(), RestoreState(
+        'restoring', 'tdi1', None, 'creating', ()))
+    account.instances['tdi1'] = {'DBInstanceIdentifier': 'tdi1',
+                                 'DBInstanceStatus': 'creating'}
+    monkeypatch.setattr(account, 'describe_db_instances', lambda DBInstanceIdentifier: {
+        'DBInstances': [dict(account.instances[DBInstanceIdentifier])]})
+
+    assert poll_restore(stack, config, test_context,
+                        handovers=restore_max_handovers - 1) == restoring
+    assert account.invocations == [{'ugc_rds_macro_restore_poll': {
+        'stackname': stack, 'handovers': restore_max_handovers}}]
+
+    assert poll_restore(stack, config, test_context,
+                        handovers=restore_max_handovers) == restoring
+    assert len(account.invocations) == 1 and store.get() == restoring
+
+
+def test_background_restore_leaves_only_the_snapshot_to_apply(monkeypatch, tmpdir):
+    class PollContext(TestContext):
+        def get_remaining_time_in_millis(self):
+            return 900000
+
+    stack = 'dv-rds-database-stack'
+    account = FakeRestoreAccount([stack])
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    monkeypatch.setenv("restore_point_in_time", "true")
+    monkeypatch.setenv("restore_in_background", "true")
+    monkeypatch.setenv("restore_state_store", "sqlite")
+    monkeypatch.setenv("restore_state_path", str(tmpdir.join('state.db')))
+    monkeypatch.setenv("restore_poll_interval_seconds", "0")
+    store = get_restore_state_store(test_context.invoked_function_arn, get_config(), stack)
+
+    def stack_update():
+        fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+        point_in_time_restore(fragment, stack, None,
+                              RdsInventory(rds_client=account), None, test_context)
+        return fragment
+
+    assert stack_update() == {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+    assert account.invocations == [{'ugc_rds_macro_restore_poll': {'stackname': stack}}]
+
+    res = handler(account.invocations[0], PollContext())
+    assert res == {'stackname': stack, 'phase': 'ready'}
+    assert len(account.deleted) == 1 and store.get().phase == 'ready'
+
+    snapshot_id = stack_update()['Properties']['DBSnapshotIdentifier']
+    assert account.restored_from(snapshot_id) == "{0}-ugc-postgres".format(stack)
+    assert store.get() == RestoreState.idle() and account.tags == {}
+
+
+def test_waiting_restore_finishes_within_one_invocation_until_the_deadline(monkeypatch):
+    class WaitContext(TestContext):
+        remaining = 900000
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining
+
+    stack = 'dv-rds-database-stack'
+    account = FakeRestoreAccount([stack])
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    monkeypatch.setenv("restore_point_in_time", "true")
+    monkeypatch.setenv("restore_wait_in_invocation", "true")
+    monkeypatch.setenv("restore_poll_interval_seconds", "0")
+    context = WaitContext()
+
+    def stack_update():
+        fragment = {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}}
+        point_in_time_restore(fragment, stack, None,
+                              RdsInventory(rds_client=account), None, context)
+        return fragment
+
+    snapshot_id = stack_update()['Properties']['DBSnapshotIdentifier']
+    assert account.restored_from(snapshot_id) == "{0}-ugc-postgres".format(stack)
+    assert account.tags == {}
+
+    # Inside the safety margin nothing is waited on.
+    context.remaining = 59000
+    assert 'DBSnapshotIdentifier' not in stack_update()['Properties']
+    assert list(account.tags) == [dv_instance_tag]
+
+
+def test_backoff_delays_double_with_jitter_up_to_the_cap():
+    class Rnd(object):
+        def uniform(self, a, b):
+            return b
+
+    class Context(object):
+        def get_remaining_time_in_millis(self):
+            return 1000
+
+    delays = lambdas.ugc_rds_macro.backoff_delays(5, 30, Rnd())
+    assert [next(delays) for _ in range(5)] == [5, 10, 20, 30, 30]
+    assert lambdas.ugc_rds_macro.get_deadline(Context(), 0.5, lambda: 0) == 0.5
+    assert lambdas.ugc_rds_macro.get_deadline(None, 0.5, lambda: 0) == 0
+
+
+def test_handler_prefetches_independent_calls_side_by_side(monkeypatch):
+    # Each call waits for the other, so this only passes when they overlap.
+    # The inventory is listed after the restore state, which shows it idle.
+    barrier = threading.Barrier(2, timeout=5)
+
+    class SlowAccount(FakeRestoreAccount):
+        def describe_stacks(self, StackName):
+            barrier.wait()
+            return {'Stacks': [{'CreationTime': datetime(2019, 12, 6)}]}
+
+        def get_template(self, StackName, TemplateStage):
+            return {'TemplateBody': {'Resources': {'UGCDatabase': {'Properties': {}}}}}
+
+        def list_tags(self, Resource):
+            barrier.wait()
+            return FakeRestoreAccount.list_tags(self, Resource)
+
+    stack = 'dv-rds-database-stack'
+    account = SlowAccount([stack])
+    for client in ('_rds', '_lambda', '_cloudformation'):
+        monkeypatch.setattr(lambdas.ugc_rds_macro, client, lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'do_not_ignore_get_template', True)
+    monkeypatch.setenv("restore_point_in_time", "true")
+    invalidate_deployed_template()
+
+    f = {'fragment': {'Properties': {'DBName': 'db'}},
+         'requestId': 'my_request_id', 'params': {'stackname': stack}}
+    res = handler(f, test_context)
+
+    assert res['fragment'] == {'Properties': {'DBName': 'db'}}
+    assert list(account.tags) == [dv_instance_tag]
+    invalidate_deployed_template()
+
+
+class FakeAsyncClients(object):
+    # The async client interface over a FakeRestoreAccount, yielding to the
+    # event loop on every call like a real network round trip would.
+
+    def __init__(self, account):
+        self.account = account
+
+    async def call(self, service_name, operation, **params):
+        await asyncio.sleep(0)
+        return getattr(self.account, operation)(**params)
+
+    async def paginate(self, service_name, operation, **params):
+        for page in self.account.get_paginator(operation).paginate(**params):
+            await asyncio.sleep(0)
+            yield page
+
+
+def test_async_handler_restores_many_stacks_on_one_event_loop(monkeypatch):
+    stacks = ["stack{0:02d}-rds-db".format(i) for i in range(20)]
+    account = FakeRestoreAccount(stacks)
+    # The restore steps are those of handler, on the sync clients.
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_rds', lambda: account)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_lambda', lambda: account)
+    monkeypatch.setenv("restore_point_in_time", "true")
+    aws = FakeAsyncClients(account)
+
+    async def restore(stack):
+        for _ in range(10):
+            event = {'fragment': {'Properties': {'DBInstanceIdentifier': 'db', 'DBName': 'db'}},
+                     'requestId': stack, 'params': {'stackname': stack}}
+            res = await async_handler(event, test_context, aws)
+            if 'DBSnapshotIdentifier' in res['fragment']['Properties']:
+                return res['fragment']['Properties']['DBSnapshotIdentifier']
+
+    async def restore_all():
+        return await asyncio.gather(*[restore(stack) for stack in stacks])
+
+    loop = asyncio.new_event_loop()
+    try:
+        snapshots = loop.run_until_complete(restore_all())
+    finally:
+        loop.close()
+
+    for stack, snapshot_id in zip(stacks, snapshots):
+        assert snapshot_id is not None
+        assert account.restored_from(snapshot_id) == "{0}-ugc-postgres".format(stack)
+    assert account.tags == {}
+    assert len(account.deleted) == len(stacks)
+
+
+def test_sync_and_async_deployed_resources_share_the_cache(monkeypatch):
+    class Stacks(object):
+        templates = 0
+        missing = False
+
+        def describe_stacks(self, StackName):
+            if self.missing:
+                raise ClientError({'Error': {'Code': 'ValidationError'}}, 'DescribeStacks')
+            return {'Stacks': [{'CreationTime': datetime(2019, 12, 6)}]}
+
+        def get_template(self, StackName, TemplateStage):
+            if self.missing:
+                raise ClientError({'Error': {'Code': 'ValidationError'}}, 'GetTemplate')
+            self.templates += 1
+            return {'TemplateBody': json.dumps({'Resources': {'UGCDatabase': {'Properties': {}}}})}
+
+    stacks = Stacks()
+    monkeypatch.setattr(lambdas.ugc_rds_macro, '_cloudformation', lambda: stacks)
+    monkeypatch.setattr(lambdas.ugc_rds_macro, 'do_not_ignore_get_template', True)
+    invalidate_deployed_template()
+    aws = FakeAsyncClients(stacks)
+
+    loop = asyncio.new_event_loop()
+    try:
+        resources = loop.run_until_complete(async_get_deployed_resources(aws, 'one'))
+        assert get_deployed_resources('one') is resources
+        assert resources == {'UGCDatabase': {'Properties': {}}} and stacks.templates == 1
+
+        stacks.missing = True
+        assert loop.run_until_complete(async_get_deployed_resources(aws, 'two')) is None
+        assert get_deployed_resources('two') is None
+    finally:
+        loop.close()
+        invalidate_deployed_template()